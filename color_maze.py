@@ -65,6 +65,16 @@ class Agent:
         '''Check if the agent is within the (inclusive!) bounds of the environment.'''
         return self.x_limit_low <= x <= self.x_limit_high and self.y_limit_low <= y <= self.y_limit_high
 
+    def move_table(self) -> list:
+        '''Lookup table where [x][y][move] is the (x, y) the move leads to from (x, y); moves past the agent's bounds stay in place.'''
+        xs, ys = np.meshgrid(np.arange(xBoundary), np.arange(yBoundary), indexing='ij')
+        table = np.stack((xs, ys), axis=-1)[:, :, None, :].repeat(NUM_MOVES, axis=2)  # (xBoundary, yBoundary, NUM_MOVES, 2)
+        table[:, :, Moves.UP.value, 1] = np.where(ys < self.y_limit_high, ys + 1, ys)
+        table[:, :, Moves.DOWN.value, 1] = np.where(ys > self.y_limit_low, ys - 1, ys)
+        table[:, :, Moves.LEFT.value, 0] = np.where(xs > self.x_limit_low, xs - 1, xs)
+        table[:, :, Moves.RIGHT.value, 0] = np.where(xs < self.x_limit_high, xs + 1, xs)
+        return table.tolist()  # Nested lists: indexing with Python ints is faster than numpy scalar indexing
+
 class ColorMazeRewards():
     '''Class to organize reward functions for the ColorMaze environment.
     
@@ -110,28 +120,21 @@ class ColorMazeRewards():
         # *Technically, surrounded by infinitely many goal blocks is most rewarding. Do the math to tune later, this is unlikely and we have 48 hours.
         leader = agents["leader"]
         follower = agents["follower"]
-        goal_positions = torch.nonzero(blocks[goal_block.value] == 1, as_tuple=False)
-        goal_positions_x = goal_positions[:, 0]
-        goal_positions_y = goal_positions[:, 1]
-        leader_x_rep = torch.full_like(goal_positions_x, leader.x)
-        leader_y_rep = torch.full_like(goal_positions_y, leader.y)
-        follower_x_rep = torch.full_like(goal_positions_x, follower.x)
-        follower_y_rep = torch.full_like(goal_positions_y, follower.y)
-        
-        rewards["leader"] += torch.sum(self._harmonic_distance_reward(leader_x_rep, leader_y_rep, goal_positions_x, goal_positions_y) * discount_factor).item()
-        rewards["follower"] += torch.sum(self._harmonic_distance_reward(follower_x_rep, follower_y_rep, goal_positions_x, goal_positions_y) * discount_factor).item() # What is item? ChatGPT suggestion
-        
+        # Both agents' harmonic distances to every cell of the board, built without torch.nonzero (which syncs on the GPU)
+        xs = torch.arange(blocks.shape[1], device=blocks.device).unsqueeze(1)
+        ys = torch.arange(blocks.shape[2], device=blocks.device).unsqueeze(0)
+        harmonic = torch.stack([self._harmonic_distance_reward(xs, ys, agent.x, agent.y) for agent in (leader, follower)])
+
+        # Goal blocks attract and all other colors repel, so one weighted sum per agent covers both terms
+        goal_mask = blocks[goal_block.value] == 1
         # Now, get incorrect positions (all other slices of 'blocks' except goal_block == 1)
-        incorrect_positions = torch.nonzero(torch.any(blocks[:goal_block.value] == 1, dim=0) | torch.any(blocks[goal_block.value + 1:] == 1, dim=0), as_tuple=False)
-        
-        incorrect_positions_x = incorrect_positions[:, 0]
-        incorrect_positions_y = incorrect_positions[:, 1]
-        leader_x_rep = torch.full_like(incorrect_positions_x, leader.x)
-        leader_y_rep = torch.full_like(incorrect_positions_y, leader.y)
-        follower_x_rep = torch.full_like(incorrect_positions_x, follower.x)
-        follower_y_rep = torch.full_like(incorrect_positions_y, follower.y)
-        rewards["leader"] += incorrect_penalty_coef * torch.sum(self._harmonic_distance_reward(leader_x_rep, leader_y_rep, incorrect_positions_x, incorrect_positions_y) * discount_factor).item()
-        rewards["follower"] += incorrect_penalty_coef * torch.sum(self._harmonic_distance_reward(follower_x_rep, follower_y_rep, incorrect_positions_x, incorrect_positions_y) * discount_factor).item()
+        incorrect_mask = torch.any(blocks[:goal_block.value] == 1, dim=0) | torch.any(blocks[goal_block.value + 1:] == 1, dim=0)
+        weights = (goal_mask + incorrect_penalty_coef * incorrect_mask) * discount_factor
+
+        # A single host transfer for both agents instead of one .item() per agent and term
+        leader_potential, follower_potential = (harmonic * weights).sum(dim=(1, 2)).tolist()
+        rewards["leader"] += leader_potential
+        rewards["follower"] += follower_potential
 
         return rewards
 
@@ -183,11 +186,20 @@ class ColorMaze(ParallelEnv):
             self.leader = Agent(Boundary.x1.value, Boundary.y1.value, x_limit_low=Boundary.x1.value, x_limit_high=self.leader_x_max_boundary, y_limit_low=Boundary.y1.value, y_limit_high=Boundary.y2.value)
             self.follower = Agent(Boundary.x2.value, Boundary.y2.value, x_limit_low=self.follower_x_min_boundary, x_limit_high=Boundary.x2.value, y_limit_low=Boundary.y1.value, y_limit_high=Boundary.y2.value)
         self.asymmetric = asymmetric
+        # Agent bounds are fixed, so every move's outcome is precomputed per agent
+        self._move_tables = {"leader": self.leader.move_table()}
+        if not leader_only:
+            self._move_tables["follower"] = self.follower.move_table()
 
         self.action_space = Discrete(NUM_MOVES)  # type: ignore # Moves: Up, Down, Left, Right
 
         # Blocks - invariant: for all (x, y) coordinates, no two slices are non-zero
-        self.blocks = torch.zeros((NUM_COLORS, xBoundary, yBoundary), device=self.device)
+        # The observation buffer is reused by every step; its block channels *are* self.blocks (a view), so only the two agent channels are rewritten
+        self._observation = torch.zeros((NUM_COLORS + 2, xBoundary, yBoundary), device=self.device)
+        self.blocks = self._observation[:NUM_COLORS]
+        # Host-side (x, y) -> color index of the block there, or -1 if empty. Mirrors self.blocks, so step() and spawning
+        # never read the (possibly GPU-resident) blocks tensor back to the CPU
+        self._block_colors = np.full((xBoundary, yBoundary), -1, dtype=np.int8)
         self.block_density = block_density
         
         self._n_channels = self.blocks.shape[0] + 2  # len(self.possible_agents)  # 5: 1 channel for each block color + 1 for each agent
@@ -217,6 +229,7 @@ class ColorMaze(ParallelEnv):
         # Environment duration
         self.timestep = 0
         self._MAX_TIMESTEPS = 1000
+        self._MAX_SPAWN_TRIES = 64  # Rejection-sampling tries before a block spawn falls back to scanning for free cells
 
         # Reward shaping
         if len(reward_shaping_fns) > 0:
@@ -234,28 +247,29 @@ class ColorMaze(ParallelEnv):
         """
         Converts the internal state of the environment into an observation that can be used by the agent.
         
-        The observation is a 3D numpy array where each cell (0 or 1) represents the presence of an object in that cell in the maze.
+        The observation is a 3D tensor where each cell (0 or 1) represents the presence of an object in that cell in the maze.
+        Channels are the block colors (a view of self.blocks), then the leader and the follower.
 
         Returns:
-            numpy.ndarray: The observation array.
+            torch.Tensor: The observation buffer of shape (5, 32, 32). It is overwritten by the next step or reset, so copy it to keep it.
         """
-        leader_position = torch.zeros((1, xBoundary, yBoundary), device=self.device)
-        leader_position[0, self.leader.x, self.leader.y] = 1
-
-        follower_position = torch.zeros((1, xBoundary, yBoundary), device=self.device)
+        observation = self._observation
+        observation[IDs.LEADER.value:].zero_()
+        observation[IDs.LEADER.value, self.leader.x, self.leader.y] = 1
         if not self.leader_only:
-            follower_position[0, self.follower.x, self.follower.y] = 1
-
-        # self.blocks.shape is (3, 32, 32)
-        # leader_position.shape is (1, 32, 32)
-        # follower_position.shape is (1, 32, 32)
-
-        observation = torch.cat((self.blocks, leader_position, follower_position), dim=0)
-
-        # Ensure that observation is a 2d array
-        assert observation.shape == (self._n_channels, xBoundary, yBoundary)
+            observation[IDs.FOLLOWER.value, self.follower.x, self.follower.y] = 1
         return observation
 
+    def bind_observation_buffer(self, buffer: torch.Tensor):
+        """
+        Makes buffer, e.g. one row of a batched (num_envs, 5, 32, 32) tensor, this env's observation buffer (and self.blocks a view of it).
+        The current state is carried over, and every later step and reset writes its observation there without a copy.
+        """
+        assert buffer.shape == self._observation.shape and buffer.device == self._observation.device
+        buffer.copy_(self._observation)
+        self._observation = buffer
+        self.blocks = buffer[:NUM_COLORS]
+
     def set_state_to_observation(self, observation: np.ndarray):
         """
         Converts the format returned from _convert_to_observation
@@ -267,8 +281,9 @@ class ColorMaze(ParallelEnv):
         assert leader_places.sum() == 1
         assert self.leader_only or follower_places.sum() == 1
         tensor_observation = torch.tensor(observation, device=self.device)
-        self.blocks = tensor_observation[IDs.RED.value : IDs.GREEN.value + 1]
+        self.blocks.copy_(tensor_observation[IDs.RED.value : IDs.GREEN.value + 1])
         assert self.blocks.shape == (NUM_COLORS, xBoundary, yBoundary)
+        self._block_colors = self._host_block_colors()
         self.leader.x, self.leader.y = np.argwhere(leader_places).flatten()
         if follower_places.sum() == 1:
             self.follower.x, self.follower.y = np.argwhere(follower_places).flatten()
@@ -303,7 +318,7 @@ class ColorMaze(ParallelEnv):
                 self.follower.x = self.rng.integers(self.follower_x_min_boundary, Boundary.x2.value, endpoint=True)
                 self.follower.y = self.rng.integers(Boundary.y1.value, Boundary.y2.value, endpoint=True)
 
-        self.blocks = torch.zeros((NUM_COLORS, xBoundary, yBoundary), device=self.device)
+        self.blocks.zero_()
 
         # Randomly place X% blocks (in a 32x32, and 10%, 34 blocks of each color)
         n_blocks_each_color = int((xBoundary * yBoundary * self.block_density) // NUM_COLORS)
@@ -327,6 +342,8 @@ class ColorMaze(ParallelEnv):
             block_positions = np.insert(block_positions, [0], [[[0]], [[1]], [[2]]], axis=2).reshape(-1, 3)
             self.blocks[block_positions[:, 0], block_positions[:, 1], block_positions[:, 2]] = 1
 
+        self._block_colors = self._host_block_colors()
+
         if self.nonstationary:
             self.goal_block = self.rng.choice(np.array([IDs.RED, IDs.GREEN, IDs.BLUE]))
 
@@ -357,8 +374,13 @@ class ColorMaze(ParallelEnv):
         infos = {a: {"individual_reward": 0} for a in self.agents}
         return observations, infos
 
+    def _host_block_colors(self) -> np.ndarray:
+        blocks = self.blocks.cpu().numpy()
+        return np.where(blocks.any(axis=0), blocks.argmax(axis=0), -1).astype(np.int8)
+
     def _consume_and_spawn_block(self, color_idx: int, x: int, y: int, blocks: torch.Tensor):
         blocks[color_idx, x, y] = 0
+        self._block_colors[x, y] = -1
         # x_high is exclusive
         if self.is_unique_hemispheres_env: # Ensure block is spawned in the same hemisphere.
             if x <= xBoundary // 2:
@@ -372,39 +394,39 @@ class ColorMaze(ParallelEnv):
             x_high = Boundary.x2.value + 1
 
         # Find a different cell that is not occupied (leader, follower, existing block) and set it to this block.
-        # Also make sure no other color is present there      
-        leader_position = torch.zeros((1, xBoundary, yBoundary), device=self.device)
-        leader_position[0, self.leader.x, self.leader.y] = 1
-
-        follower_position = torch.zeros((1, xBoundary, yBoundary), device=self.device)
-        if not self.leader_only:
-            follower_position[0, self.follower.x, self.follower.y] = 1
-
-        observation = torch.cat((self.blocks, leader_position, follower_position), dim=0)
-        zero_indices = torch.argwhere(torch.all((observation[:, x_low:x_high, :] == 0), dim=0))
-        i = torch.randint(low=0, high=len(zero_indices), size=(1,))
-        x = zero_indices[i, 0] + x_low
-        y = zero_indices[i, 1]
-        blocks[color_idx, x, y] = 1
+        # Rejection sampling against the occupancy grid is uniform over the free cells, and each try is a single lookup
+        # instead of rebuilding the full observation and scanning it for empty cells.
+        # Both coordinates come from one draw of the env's seeded rng, rather than two torch.randint tensors per try.
+        for _ in range(self._MAX_SPAWN_TRIES):
+            spawn_x, spawn_y = self.rng.integers((x_low, Boundary.y1.value), (x_high, Boundary.y2.value + 1))
+            if self._block_colors[spawn_x, spawn_y] >= 0 or (spawn_x, spawn_y) == (self.leader.x, self.leader.y):
+                continue
+            if not self.leader_only and (spawn_x, spawn_y) == (self.follower.x, self.follower.y):
+                continue
+            break
+        else:
+            # A (nearly) full region: pick uniformly among its free cells, which also terminates when there are none
+            occupied = self._block_colors >= 0
+            occupied[self.leader.x, self.leader.y] = True
+            if not self.leader_only:
+                occupied[self.follower.x, self.follower.y] = True
+            free_cells = np.argwhere(~occupied[x_low:x_high, Boundary.y1.value:Boundary.y2.value + 1])
+            if len(free_cells) == 0:
+                raise ValueError("No free cell left to spawn a block in")
+            spawn_x, spawn_y = free_cells[self.rng.integers(len(free_cells))] + (x_low, Boundary.y1.value)
+        blocks[color_idx, spawn_x, spawn_y] = 1
+        self._block_colors[spawn_x, spawn_y] = color_idx
         return
 
     def step(self, actions):
         """
         Takes an action for all agents in environment, and assigns rewards.
         """
-        def _move(x, y, action, agent:Agent):
+        def _move(x, y, action, move_table: list):
             """
             Always call _move for the leader first in a given timestep. The leader is favored in collisions with follower. 
             """
-            new_x, new_y = x, y
-            if action == Moves.UP.value and y < agent.y_limit_high:
-                new_y += 1
-            elif action == Moves.DOWN.value and y > agent.y_limit_low:
-                new_y -= 1
-            elif action == Moves.LEFT.value and x > agent.x_limit_low:
-                new_x -= 1
-            elif action == Moves.RIGHT.value and x < agent.x_limit_high:
-                new_x += 1
+            new_x, new_y = move_table[x][y][action]
     
             if (new_x, new_y) == (self.leader.x, self.leader.y):
                 return x, y
@@ -412,10 +434,10 @@ class ColorMaze(ParallelEnv):
                 return new_x, new_y
         
         leader_action = actions["leader"]
-        self.leader.x, self.leader.y = _move(self.leader.x, self.leader.y, leader_action, self.leader)
+        self.leader.x, self.leader.y = _move(self.leader.x, self.leader.y, leader_action, self._move_tables["leader"])
         if not self.leader_only:
             follower_action = actions["follower"]
-            self.follower.x, self.follower.y = _move(self.follower.x, self.follower.y, follower_action, self.follower)
+            self.follower.x, self.follower.y = _move(self.follower.x, self.follower.y, follower_action, self._move_tables["follower"])
 
         blocks_collected = {agent: {"goal": 0, "incorrect": 0} for agent in self.agents}
 
@@ -427,19 +449,18 @@ class ColorMaze(ParallelEnv):
         for agent, x, y in zip(self.agents, x_pos, y_pos):
             individual_rewards[agent] = 0
 
-            if self.blocks[self.goal_block.value, x, y]:
+            # At most one block per cell, so a single host-side lookup tells which block (if any) the agent stepped on
+            block_color = self._block_colors[x, y]
+            if block_color == self.goal_block.value:
                 shared_reward += self.positive_reward
                 individual_rewards[agent] += self.positive_reward
                 self._consume_and_spawn_block(self.goal_block.value, x, y, self.blocks)
                 blocks_collected[agent]["goal"] += 1
-            else:
-                for non_reward_block_idx in [i for i in range(self.blocks.shape[0]) if i != self.goal_block.value]:
-                    if self.blocks[non_reward_block_idx, x, y]:
-                        shared_reward += self.negative_reward * self.block_penalty_coef
-                        individual_rewards[agent] += self.negative_reward * self.block_penalty_coef
-                        self._consume_and_spawn_block(non_reward_block_idx, x, y, self.blocks)
-                        blocks_collected[agent]["incorrect"] += 1
-                        break  # Can't step on two non-rewarding blocks at once
+            elif block_color >= 0:
+                shared_reward += self.negative_reward * self.block_penalty_coef
+                individual_rewards[agent] += self.negative_reward * self.block_penalty_coef
+                self._consume_and_spawn_block(int(block_color), x, y, self.blocks)
+                blocks_collected[agent]["incorrect"] += 1
 
         rewards = {agent: shared_reward for agent in self.agents}
 
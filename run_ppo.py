@@ -1,34 +1,104 @@
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 import torch.optim as optim
-from torch.distributions import Categorical
+import torch.distributed as dist
 import numpy as np
-from typing import Mapping, Sequence, Tuple
+from typing import Mapping, Tuple
 from dataclasses import dataclass
 import wandb
 from fire import Fire
 from tqdm import tqdm
 import os
-from pettingzoo import ParallelEnv
+from functools import lru_cache, partial
 
 from color_maze import ColorMaze, ColorMazeRewards, NUM_COLORS
+from vector_color_maze import VectorColorMaze
 
 @dataclass
 class StepData:
-    observations: torch.Tensor
-    actions: torch.Tensor
-    rewards: torch.Tensor
+    reward: float  # Summed along the step dim and averaged along the env dim
     individual_rewards: np.ndarray
     shared_rewards: np.ndarray
-    dones: torch.Tensor
-    action_log_probs: torch.Tensor
-    action_entropies: np.ndarray
-    values: torch.Tensor
+    action_entropy: float  # Averaged over steps and envs
     loss: float
     explained_var: float
-    goal_info: torch.Tensor
     collected_blocks_goal: torch.Tensor # 0 or 1
     collected_blocks_incorrect: torch.Tensor # 0 or 1
+    # Full rollout tensors, only copied to the CPU when step() is called with return_trajectories=True
+    observations: torch.Tensor | None = None
+    goal_info: torch.Tensor | None = None
+    actions: torch.Tensor | None = None
+    rewards: torch.Tensor | None = None
+    dones: torch.Tensor | None = None
+    action_log_probs: torch.Tensor | None = None
+    values: torch.Tensor | None = None
+
+
+@dataclass
+class RolloutBuffer:
+    """Per-agent rollout storage. Allocated once in train() and overwritten by every call to step(), so rollouts never reallocate."""
+    observations: torch.Tensor  # (num_steps, num_envs, channels, x, y), shared by agents on the same device
+    next_observations: torch.Tensor  # (num_envs, channels, x, y)
+    goal_info: torch.Tensor  # (num_steps, num_envs, NUM_COLORS)
+    next_goal_info: torch.Tensor  # (num_envs, NUM_COLORS)
+    actions: torch.Tensor  # (num_steps, num_envs)
+    logprobs: torch.Tensor  # (num_steps, num_envs)
+    rewards: torch.Tensor  # (num_steps, num_envs)
+    dones: torch.Tensor  # (num_steps, num_envs)
+    next_dones: torch.Tensor  # (num_envs,)
+    values: torch.Tensor  # (num_steps, num_envs)
+    lstm_hidden_states: torch.Tensor  # (num_steps + 1, num_envs, hidden_size); num_steps + 1 so that indexing by step gives the *input* states at that step
+    lstm_cell_states: torch.Tensor  # (num_steps + 1, num_envs, hidden_size)
+    # (Pinned) host staging tensors: env outputs are written here and copied to the device once per agent per step
+    host_goal_info: torch.Tensor  # (num_envs, NUM_COLORS)
+    host_rewards: torch.Tensor  # (num_envs,)
+    host_dones: torch.Tensor  # (num_envs,)
+    entropies: torch.Tensor  # (num_steps, num_envs), only used for logging
+    # Per-step env statistics, only used for logging. They arrive from the envs on the host, so they are stored there.
+    individual_rewards: torch.Tensor  # (num_steps, num_envs)
+    shared_rewards: torch.Tensor  # (num_steps, num_envs)
+    collected_blocks_goal: torch.Tensor  # (num_steps, num_envs), 0 or 1
+    collected_blocks_incorrect: torch.Tensor  # (num_steps, num_envs), 0 or 1
+
+    @classmethod
+    def allocate(cls, models: Mapping[str, 'ActorCritic'], num_steps: int, num_envs: int, observation_shape: tuple, goal_info_shape: tuple, action_shape: tuple,
+                 amp_dtype: torch.dtype | None = None, channels_last: bool = False) -> dict[str, 'RolloutBuffer']:
+        # Observations are 0/1 and only used as model inputs, so they are stored exactly in the autocast dtype when mixed precision is on
+        observation_dtype = amp_dtype or torch.float32
+        pin_memory = torch.cuda.is_available()
+        buffers = {}
+        for agent, model in models.items():
+            # Every agent observes the same board, so agents whose models share a device also share one set of observation buffers
+            sharing_agents = [other for other in buffers if models[other].device == model.device]
+            if sharing_agents:
+                observations, next_observations = buffers[sharing_agents[0]].observations, buffers[sharing_agents[0]].next_observations
+            else:
+                observations = observation_zeros((num_steps, num_envs), observation_shape, channels_last, dtype=observation_dtype, device=model.device)  # shape: (128, 4) + (5, 32, 32) -> (128, 4, 5, 32, 32)
+                next_observations = observation_zeros((num_envs,), observation_shape, channels_last, dtype=observation_dtype, device=model.device)
+            buffers[agent] = cls(
+                observations=observations,
+                next_observations=next_observations,
+                goal_info=torch.zeros((num_steps, num_envs) + goal_info_shape, device=model.device),
+                next_goal_info=torch.zeros((num_envs,) + goal_info_shape, device=model.device),
+                actions=torch.zeros((num_steps, num_envs) + action_shape, dtype=torch.long, device=model.device),
+                logprobs=torch.zeros((num_steps, num_envs), device=model.device),
+                rewards=torch.zeros((num_steps, num_envs), device=model.device),
+                dones=torch.zeros((num_steps, num_envs), device=model.device),
+                next_dones=torch.zeros(num_envs, device=model.device),
+                values=torch.zeros((num_steps, num_envs), device=model.device),
+                lstm_hidden_states=torch.zeros((num_steps + 1, num_envs, model.hidden_size), device=model.device),
+                lstm_cell_states=torch.zeros((num_steps + 1, num_envs, model.hidden_size), device=model.device),
+                host_goal_info=torch.zeros((num_envs,) + goal_info_shape, pin_memory=pin_memory),
+                host_rewards=torch.zeros(num_envs, pin_memory=pin_memory),
+                host_dones=torch.zeros(num_envs, pin_memory=pin_memory),
+                entropies=torch.zeros((num_steps, num_envs), device=model.device),
+                individual_rewards=torch.zeros((num_steps, num_envs)),
+                shared_rewards=torch.zeros((num_steps, num_envs)),
+                collected_blocks_goal=torch.zeros((num_steps, num_envs)),
+                collected_blocks_incorrect=torch.zeros((num_steps, num_envs)),
+            )
+        return buffers
 
 
 DEVICE = 'cuda' if torch.cuda.is_available() else 'cpu'
@@ -40,6 +110,71 @@ def layer_init(layer, std=np.sqrt(2), bias_const=0.0):
     return layer
 
 
+@lru_cache(maxsize=None)
+def _gae_masks(chunk_size: int, device: torch.device):
+    """(after, on_or_after) masks of shape (chunk_size, chunk_size, 1) for compute_gae. Only the chunk length and the final partial chunk's length are ever cached."""
+    steps = torch.arange(chunk_size, device=device)
+    after = (steps.view(1, -1) > steps.view(-1, 1)).unsqueeze(-1)
+    on_or_after = (steps.view(1, -1) >= steps.view(-1, 1)).unsqueeze(-1)
+    return after, on_or_after
+
+
+def compute_gae(rewards, values, dones, next_value, next_done, gamma: float, gae_lambda: float, chunk_size: int = 32):
+    """Generalized advantage estimation for a (num_steps, num_envs) rollout, scanning backwards over chunks of timesteps.
+
+    Within a chunk, advantages[t] = sum_{k >= t} (prod_{j=t}^{k-1} gamma * lambda * nonterminal[j]) * delta[k] plus the
+    discounted advantage carried in from the next chunk. The products are built with a cumprod over a (chunk_size, chunk_size, num_envs)
+    tensor, which stays exact at episode ends; memory is bounded by chunk_size and the Python loop runs num_steps / chunk_size times.
+    """
+    num_steps = rewards.size(0)
+    next_values = torch.cat((values[1:], next_value.reshape(1, -1)), dim=0)
+    next_nonterminal = 1 - torch.cat((dones[1:], next_done.reshape(1, -1)), dim=0)
+    deltas = rewards + gamma * next_values * next_nonterminal - values
+    discounts = gamma * gae_lambda * next_nonterminal
+
+    advantages = torch.empty_like(deltas)
+    carry = torch.zeros_like(deltas[0])  # Advantage at the first step after the current chunk
+    for end in range(num_steps, 0, -chunk_size):
+        start = max(0, end - chunk_size)
+        chunk_deltas, chunk_discounts = deltas[start:end], discounts[start:end]
+        # factors[t, k] = discounts[k - 1] for k > t, else 1; weights[t, k] = prod of factors[t, :k+1] for k >= t, else 0
+        after, on_or_after = _gae_masks(end - start, rewards.device)
+        factors = torch.where(after, chunk_discounts.roll(1, dims=0).unsqueeze(0), 1.0)
+        weights = factors.cumprod(dim=1) * on_or_after
+        # weights[:, -1] * discounts[end - 1] is the product of every discount from t to the end of the chunk
+        advantages[start:end] = (weights * chunk_deltas.unsqueeze(0)).sum(dim=1) + weights[:, -1] * chunk_discounts[-1] * carry
+        carry = advantages[start]
+    return advantages
+
+
+def observation_zeros(leading_shape: tuple, observation_shape: tuple, channels_last: bool = False, **kwargs):
+    """Zero observation buffer of shape leading_shape + observation_shape.
+
+    With channels_last, memory is laid out as (..., x, y, channels) so every (batch, channels, x, y) slice is already a channels_last conv input.
+    """
+    if not channels_last:
+        return torch.zeros(leading_shape + observation_shape, **kwargs)
+    channels, *spatial = observation_shape
+    return torch.zeros(leading_shape + tuple(spatial) + (channels,), **kwargs).movedim(-1, -3)
+
+
+def autocast(device: str, amp_dtype: torch.dtype | None, cache_enabled: bool = True):
+    """Mixed-precision context for the model forward; a no-op when amp_dtype is None."""
+    return torch.autocast(device_type=torch.device(device).type, dtype=amp_dtype, enabled=amp_dtype is not None, cache_enabled=cache_enabled)
+
+
+def all_reduce_gradients(model: nn.Module):
+    """Averages gradients across distributed ranks with a single all-reduce over one flattened buffer."""
+    grads = [param.grad for param in model.parameters() if param.grad is not None]
+    flat_grads = torch.cat([grad.flatten() for grad in grads])
+    dist.all_reduce(flat_grads)
+    flat_grads /= dist.get_world_size()
+    offset = 0
+    for grad in grads:
+        grad.copy_(flat_grads[offset:offset + grad.numel()].view_as(grad))
+        offset += grad.numel()
+
+
 class ActorCritic(nn.Module):
     def __init__(self, observation_space, action_space, device, use_lstm=False):
         super().__init__()
@@ -56,8 +191,11 @@ class ActorCritic(nn.Module):
             layer_init(nn.Conv2d(64, 64, kernel_size=3, stride=1, padding=0)),
             nn.LeakyReLU(),
         ).to(device)
+        # Size of the flattened conv output (64 * 26 * 26 on the 32x32 board), probed once instead of hard-coded for one board size
+        with torch.no_grad():
+            conv_output_size = self.conv_network(torch.zeros((1,) + observation_space.shape, device=device)).numel()
         self.projection_linear = nn.Sequential(
-            layer_init(nn.Linear(43264, 192)).to(device),
+            layer_init(nn.Linear(conv_output_size, 192)).to(device),
             nn.Tanh(),
         )
         self.feature_linear = nn.Sequential(
@@ -88,31 +226,43 @@ class ActorCritic(nn.Module):
             layer_init(nn.Linear(64, NUM_COLORS))
         ).to(device)
 
-    def forward(self, x, goal_info, prev_hidden_and_cell_states: tuple | None = None):
-        batch_size = x.size(0)
-
+    def trunk(self, x):
+        """Board features of shape (batch_size, 192). Agents sharing a trunk can compute these once and pass them to both forwards."""
         # Apply conv network
         features = self.conv_network(x)
 
         # Flatten convolution output channels into linear input
         # New shape: (batch_size, flattened_size)
         features = features.flatten(start_dim=1)
-        features = self.projection_linear(features)
+        return self.projection_linear(features)
+
+    def share_trunk_with(self, other: 'ActorCritic'):
+        """Uses other's conv network and projection (the same modules and parameters) instead of this model's own."""
+        self.conv_network = other.conv_network
+        self.projection_linear = other.projection_linear
+
+    def _features(self, x, goal_info, trunk_features=None):
+        if trunk_features is None:
+            trunk_features = self.trunk(x)
 
         # Append one-hot reward encoding
-        features = torch.cat((features, goal_info), dim=1)
-        features = self.feature_linear(features)
+        features = torch.cat((trunk_features, goal_info), dim=1)
+        return self.feature_linear(features)
+
+    def forward(self, x, goal_info, prev_hidden_and_cell_states: tuple | None = None, trunk_features=None):
+        batch_size = x.size(0)
+        features = self._features(x, goal_info, trunk_features)
 
         if self.use_lstm:
-            # Pass through LSTM; add singular sequence length dimension for LSTM input
-            features = features.reshape(batch_size, 1, -1)
+            # Advance the LSTM by one step. Inputs get a singular sequence dim, (batch_size, feature_size) --> (batch_size, 1, feature_size),
+            # and states a singular layer dim, (batch_size, hidden_size) --> (1, batch_size, hidden_size). Both are views, not copies.
             if prev_hidden_and_cell_states is not None:
-                prev_hidden_states = prev_hidden_and_cell_states[0].reshape(1, batch_size, self.hidden_size)
-                prev_cell_states = prev_hidden_and_cell_states[1].reshape(1, batch_size, self.hidden_size)
-                prev_hidden_and_cell_states = (prev_hidden_states, prev_cell_states)
-            features, (hidden_states, cell_states) = self.lstm(features, prev_hidden_and_cell_states)
-            # features: (batch_size, 1, feature_size) --> (batch_size, feature_size)
-            features = features[:, -1, ...].squeeze(1)
+                prev_hidden_and_cell_states = (prev_hidden_and_cell_states[0].unsqueeze(0), prev_hidden_and_cell_states[1].unsqueeze(0))
+            features, (hidden_states, cell_states) = self.lstm(features.unsqueeze(1), prev_hidden_and_cell_states)
+            features, hidden_states, cell_states = features.squeeze(1), hidden_states.squeeze(0), cell_states.squeeze(0)
+        elif prev_hidden_and_cell_states is not None:
+            # Without an LSTM the states stay zero; pass them through instead of allocating new ones every call
+            hidden_states, cell_states = prev_hidden_and_cell_states
         else:
             hidden_states, cell_states = torch.zeros((batch_size, self.hidden_size), device=self.device), torch.zeros((batch_size, self.hidden_size), device=self.device)
 
@@ -123,19 +273,184 @@ class ActorCritic(nn.Module):
             (hidden_states, cell_states)
         )
 
+    def forward_sequence(self, x, goal_info, initial_hidden_and_cell_states: tuple, dones=None):
+        """Runs the LSTM over whole (num_steps, batch_size) trajectories, so the update backpropagates through time.
+
+        dones[t] marks envs whose episode restarted at step t; their states are zeroed before that step, as in the rollout.
+        Without dones the whole sequence is a single cuDNN call. Outputs match forward, flattened to (num_steps * batch_size, ...).
+        """
+        num_steps, batch_size = x.shape[:2]
+        features = self._features(x.flatten(0, 1), goal_info.flatten(0, 1)).view(num_steps, batch_size, -1)
+        hidden_states, cell_states = initial_hidden_and_cell_states[0].unsqueeze(0), initial_hidden_and_cell_states[1].unsqueeze(0)
+        if dones is None:
+            features, (hidden_states, cell_states) = self.lstm(features.transpose(0, 1), (hidden_states, cell_states))
+            features = features.transpose(0, 1)
+        else:
+            step_features = []
+            for step in range(num_steps):
+                keep = (1 - dones[step]).view(1, -1, 1)
+                step_output, (hidden_states, cell_states) = self.lstm(features[step].unsqueeze(1), (hidden_states * keep, cell_states * keep))
+                step_features.append(step_output.squeeze(1))
+            features = torch.stack(step_features)
+        features = features.flatten(0, 1)
+
+        return (
+            self.policy_network(features),
+            self.value_network(features),
+            self.auxiliary_goalinfo_network(features),
+            (hidden_states.squeeze(0), cell_states.squeeze(0))
+        )
+
+    def script_submodules(self, observation_shape: tuple, batch_size: int):
+        """Compiles the feed-forward submodules with TorchScript so their elementwise chains get fused and Python dispatch is skipped.
+
+        The LSTM stays eager since cuDNN already runs it as a single kernel. Parameter names, and so checkpoints, are unchanged.
+        """
+        for name in ('conv_network', 'projection_linear', 'feature_linear', 'policy_network', 'value_network', 'auxiliary_goalinfo_network'):
+            setattr(self, name, torch.jit.script(getattr(self, name)))
+
+        # The first few calls of a scripted module profile and optimize its graph; pay for that here instead of in the first rollout
+        with torch.no_grad():
+            dummy_observations = torch.zeros((batch_size,) + observation_shape, device=self.device)
+            dummy_goal_info = torch.zeros((batch_size, NUM_COLORS), device=self.device)
+            for _ in range(3):
+                self(dummy_observations, dummy_goal_info)
+
     def get_value(self, x, goal_info, prev_hidden_and_cell_states: tuple | None = None):
-        return self.forward(x, goal_info=goal_info, prev_hidden_and_cell_states=prev_hidden_and_cell_states)[1]
+        return self(x, goal_info=goal_info, prev_hidden_and_cell_states=prev_hidden_and_cell_states)[1].float()
 
     def get_action_and_value(self, x, goal_info, action=None, prev_hidden_and_cell_states: tuple | None = None, sampling_temperature: float = 1.0):
-        logits, value, goalinfo_logits, (hidden_states, cell_states) = self(x, goal_info=goal_info, prev_hidden_and_cell_states=prev_hidden_and_cell_states)
-        probs = Categorical(logits=logits)
-        if action is None:
-            sampling_probs = Categorical(logits=logits / sampling_temperature)
-            action = sampling_probs.sample()
-        return action, probs.log_prob(action), probs.entropy(), value, goalinfo_logits, (hidden_states, cell_states)
+        outputs = self(x, goal_info=goal_info, prev_hidden_and_cell_states=prev_hidden_and_cell_states)
+        return action_and_value_from_outputs(*outputs, action=action, sampling_temperature=sampling_temperature)
+
+
+def gumbel_noise(shape, device):
+    """Standard Gumbel samples, -log(-log(U)) for U ~ Uniform(0, 1)."""
+    uniform = torch.rand(shape, device=device).clamp_(min=1e-20)
+    return -torch.log(-torch.log(uniform))
+
+
+def sample_actions(logits, sampling_temperature: float = 1.0, noise=None):
+    """Gumbel-max sampling: argmax(logits / T + Gumbel noise) is a draw from softmax(logits / T), without a multinomial call.
+
+    noise can be pre-drawn with gumbel_noise (e.g. for a whole rollout at once); otherwise it is drawn here.
+    """
+    if noise is None:
+        noise = gumbel_noise(logits.shape, logits.device)
+    return (logits / sampling_temperature + noise).argmax(dim=-1)
+
+
+def sample_agent_actions(logits: Mapping[str, torch.Tensor], sampling_temperature: float = 1.0, noise=None) -> dict[str, torch.Tensor]:
+    """Samples every agent's actions in one batched call when all of their logits live on the same device.
+
+    noise, if given, covers the concatenated logits and is only used for that batched call.
+    """
+    if len({agent_logits.device for agent_logits in logits.values()}) > 1:
+        return {agent: sample_actions(agent_logits, sampling_temperature) for agent, agent_logits in logits.items()}
+    actions = sample_actions(torch.cat(list(logits.values())), sampling_temperature, noise=noise)
+    return dict(zip(logits, actions.split([agent_logits.size(0) for agent_logits in logits.values()])))
+
+
+def log_prob_and_entropy(logits, action):
+    """Log-probability of action and policy entropy (as in torch.distributions.Categorical) from a single log_softmax."""
+    log_probs = F.log_softmax(logits, dim=-1)
+    action_log_probs = log_probs.gather(-1, action.unsqueeze(-1)).squeeze(-1)
+    entropy = -(log_probs.exp() * log_probs).sum(dim=-1)
+    return action_log_probs, entropy
+
+
+def action_and_value_from_outputs(logits, value, goalinfo_logits, hidden_and_cell_states: tuple, action=None, sampling_temperature: float = 1.0):
+    """Samples (or scores) actions from the raw outputs of ActorCritic.forward."""
+    # Outputs may be half precision under autocast; sample and compute losses in fp32
+    logits, value, goalinfo_logits = logits.float(), value.float(), goalinfo_logits.float()
+    if action is None:
+        action = sample_actions(logits, sampling_temperature)
+    action_log_probs, entropy = log_prob_and_entropy(logits, action)
+    return action, action_log_probs, entropy, value, goalinfo_logits, hidden_and_cell_states
+
+
+def ppo_losses(newlogprob, entropy, newvalue, old_logprob, advantages, returns, old_values,
+               clip_param: float, entropy_coef: float, value_func_coef: float, clip_vloss: bool, norm_advantage: bool):
+    """Clipped PPO objective for one minibatch. Returns (loss, approx_kl); approx_kl is detached.
+
+    Every term is reduced to a scalar before the terms are combined, so loss is a scalar and there is a single backward.
+    """
+    # The model's outputs are flattened to (minibatch,) like the stored targets; a trailing singleton dim would
+    # otherwise broadcast each term against the targets into a (minibatch, minibatch) tensor
+    newlogprob, newvalue = newlogprob.view(-1), newvalue.view(-1)
+    logratio = newlogprob - old_logprob
+    ratio = logratio.exp()
+
+    # calculate approx_kl http://joschu.net/blog/kl-approx.html
+    approx_kl = ((ratio - 1) - logratio).mean().detach()
+
+    if norm_advantage:
+        advantages = (advantages - advantages.mean()) / (advantages.std() + 1e-8)
+
+    # Policy loss
+    pg_loss1 = -advantages * ratio
+    pg_loss2 = -advantages * torch.clamp(ratio, 1 - clip_param, 1 + clip_param)
+    pg_loss = torch.max(pg_loss1, pg_loss2).mean()
+
+    # Value loss
+    if clip_vloss:
+        v_loss_unclipped = (newvalue - returns) ** 2
+        v_clipped = old_values + torch.clamp(
+            newvalue - old_values,
+            -clip_param,
+            clip_param,
+        )
+        v_loss_clipped = (v_clipped - returns) ** 2
+        v_loss_max = torch.max(v_loss_unclipped, v_loss_clipped)
+        v_loss = 0.5 * v_loss_max.mean()
+    else:
+        v_loss = 0.5 * ((newvalue - returns) ** 2).mean()
+
+    entropy_loss = entropy.mean()
+    loss = pg_loss - entropy_coef * entropy_loss + v_loss * value_func_coef
+    return loss, approx_kl
+
+
+@lru_cache(maxsize=None)
+def compiled_ppo_losses():
+    """ppo_losses compiled with torch.compile; the loss is a chain of pointwise ops that inductor fuses into a few kernels.
+
+    Built on first use, so runs without --compile (and the env worker processes that re-import this module) never load dynamo.
+    """
+    return torch.compile(ppo_losses, dynamic=False)
+
+
+class CUDAGraphRollout:
+    """Records the rollout forward of a model for a fixed batch shape into a CUDA graph and replays it every step.
+
+    Outputs live in static tensors that the next replay overwrites, so copy anything that must outlive a step.
+    """
+    def __init__(self, model: ActorCritic, observations, goal_info, hidden_states, cell_states, amp_dtype: torch.dtype | None = None):
+        self.static_inputs = (observations.clone(), goal_info.clone(), hidden_states.clone(), cell_states.clone())
+        static_observations, static_goal_info, static_hidden_states, static_cell_states = self.static_inputs
+
+        with torch.cuda.device(model.device):
+            # Warm up on a side stream before capturing, as torch.cuda.graph requires
+            side_stream = torch.cuda.Stream()
+            side_stream.wait_stream(torch.cuda.current_stream())
+            # No autocast weight-cast cache: a captured graph would keep replaying casts of the pre-update weights
+            with torch.cuda.stream(side_stream), torch.no_grad(), autocast(model.device, amp_dtype, cache_enabled=False):
+                for _ in range(3):
+                    model(static_observations, static_goal_info, prev_hidden_and_cell_states=(static_hidden_states, static_cell_states))
+            torch.cuda.current_stream().wait_stream(side_stream)
+
+            self.graph = torch.cuda.CUDAGraph()
+            with torch.cuda.graph(self.graph), torch.no_grad(), autocast(model.device, amp_dtype, cache_enabled=False):
+                self.static_outputs = model(static_observations, static_goal_info, prev_hidden_and_cell_states=(static_hidden_states, static_cell_states))
+
+    def __call__(self, observations, goal_info, hidden_states, cell_states):
+        for static_input, new_input in zip(self.static_inputs, (observations, goal_info, hidden_states, cell_states)):
+            static_input.copy_(new_input)
+        self.graph.replay()
+        return self.static_outputs
 
 def step(
-        envs: Sequence[ParallelEnv],
+        envs: VectorColorMaze,
         models: Mapping[str, ActorCritic],
         optimizers: Mapping[str, optim.Optimizer],
         num_steps: int,
@@ -152,237 +467,349 @@ def step(
         max_grad_norm: float,
         seeds: list[int],
         training_agents: dict[str, bool],
+        buffers: Mapping[str, 'RolloutBuffer'],
         target_kl: float | None,
         block_penalty_coef: float,
         sampling_temperature: float = 1.0,
         goalinfo_loss_coef: float = 0,
+        amp_dtype: torch.dtype | None = None,
+        grad_scalers: Mapping[str, torch.amp.GradScaler] | None = None,
+        rollout_graphs: Mapping[str, CUDAGraphRollout] | None = None,
+        return_trajectories: bool = False,
+        compile_losses: bool = False,
+        concurrent_agents: bool = False,
+        sequence_bptt: bool = False,
+        shared_trunk: bool = False,
+        concurrent_updates: bool = False,
 ) -> Tuple[dict[str, StepData], int]:
     """
     Implementation is based on https://github.com/vwxyzjn/cleanrl/blob/master/cleanrl/ppo.py and adapted for multi-agent
     """
-    observation_space_shapes = {
-        agent: envs[0].observation_spaces[agent]["observation"].shape # type: ignore
-        for agent in models
-    }
-
-    goal_info_shapes = {
-        agent: envs[0].observation_spaces[agent]["goal_info"].shape # type: ignore
-        for agent in models
-    }
-
-    observation_space_shapes = {key: value for key, value in observation_space_shapes.items() if value is not None}
-    assert len(observation_space_shapes) == len(models)
-    action_space_shapes = {
-        agent: envs[0].action_space.shape
-        for agent in models
-    }
-    action_space_shapes = {key: value for key, value in action_space_shapes.items() if value is not None}
-    assert len(action_space_shapes) == len(models)
-
-    all_observations = {agent: torch.zeros((num_steps, len(envs)) + observation_space_shapes[agent]).to(models[agent].device) for agent in models}  # shape: (128, 4) + (5, 32, 32) -> (128, 4, 5, 32, 32)
-
-    all_goal_info = {
-       agent: torch.zeros((num_steps, len(envs)) + goal_info_shapes[agent]).to(models[agent].device)
-       for agent in models
-    }
-    all_actions = {agent: torch.zeros((num_steps, len(envs)) + action_space_shapes[agent]).to(models[agent].device) for agent in models}
-    all_logprobs = {agent: torch.zeros((num_steps, len(envs))).to(models[agent].device) for agent in models}
-    all_rewards = {agent: torch.zeros((num_steps, len(envs))).to(models[agent].device) for agent in models}
-    all_individual_rewards = {agent: np.zeros((num_steps, len(envs))) for agent in models}
-    all_shared_rewards = {agent: np.zeros((num_steps, len(envs))) for agent in models}
-    all_dones = {agent: torch.zeros((num_steps, len(envs))).to(models[agent].device) for agent in models}
-    all_values = {agent: torch.zeros((num_steps, len(envs))).to(models[agent].device) for agent in models}
-    all_entropies = {agent: np.zeros((num_steps, len(envs))) for agent in models}
-    all_collect_blocks_goal = {agent: torch.zeros((num_steps, len(envs))) for agent in models} 
-    all_collect_blocks_incorrect = {agent: torch.zeros((num_steps, len(envs))) for agent in models} # "Did agent collect a bad block? 0 or 1 for each step, for each env"
-
-    # num_steps + 1 so that indexing by step gives the *input* states at that step
-    lstm_hidden_states = {agent: torch.zeros((num_steps + 1, len(envs), models[agent].hidden_size)).to(models[agent].device) for agent in models}
-    lstm_cell_states = {agent: torch.zeros((num_steps + 1, len(envs), models[agent].hidden_size)).to(models[agent].device) for agent in models}
-
-    next_observation_dicts, info_dicts = list(zip(*[env.reset(seed=seed, options={"block_penalty_coef": block_penalty_coef}) for env, seed in zip(envs, seeds)])) # [env1{leader:{obs:.., goal_info:..}, follower:{..}} , env2...]
-
-    next_observations = {
-        agent: torch.stack([obs_dict[agent]["observation"] for obs_dict in next_observation_dicts])
-        for agent in models
-    }
-    next_goal_info = {
-        agent: np.array([obs_dict[agent]["goal_info"] for obs_dict in next_observation_dicts])
-        for agent in models
-    }
-    next_goal_info = {agent: torch.tensor(next_goal_info[agent], dtype=torch.float32).to(models[agent].device) for agent in models}
-    next_dones = {agent: torch.zeros(len(envs)).to(models[agent].device) for agent in models}
-
-    next_individual_rewards = {
-        agent: np.array([info_dict[agent]["individual_reward"] for info_dict in info_dicts])
-        for agent in models
-    }
+    num_envs = envs.num_envs
+    all_observations = {agent: buffers[agent].observations for agent in models}
+    next_observations = {agent: buffers[agent].next_observations for agent in models}
+    # One agent per distinct buffer, so each buffer is written once per step
+    observation_owners = list({id(all_observations[agent]): agent for agent in models}.values())
+    all_goal_info = {agent: buffers[agent].goal_info for agent in models}
+    all_actions = {agent: buffers[agent].actions for agent in models}
+    all_logprobs = {agent: buffers[agent].logprobs for agent in models}
+    all_rewards = {agent: buffers[agent].rewards for agent in models}
+    all_individual_rewards = {agent: buffers[agent].individual_rewards.numpy() for agent in models}
+    all_shared_rewards = {agent: buffers[agent].shared_rewards.numpy() for agent in models}
+    all_dones = {agent: buffers[agent].dones for agent in models}
+    all_values = {agent: buffers[agent].values for agent in models}
+    all_entropies = {agent: buffers[agent].entropies for agent in models}
+    all_collect_blocks_goal = {agent: buffers[agent].collected_blocks_goal.numpy() for agent in models}
+    all_collect_blocks_incorrect = {agent: buffers[agent].collected_blocks_incorrect.numpy() for agent in models} # "Did agent collect a bad block? 0 or 1 for each step, for each env"
+
+    lstm_hidden_states = {agent: buffers[agent].lstm_hidden_states for agent in models}
+    lstm_cell_states = {agent: buffers[agent].lstm_cell_states for agent in models}
+    next_goal_info = {agent: buffers[agent].next_goal_info for agent in models}
+    next_dones = {agent: buffers[agent].next_dones for agent in models}
+    host_goal_info = {agent: buffers[agent].host_goal_info for agent in models}
+    host_rewards = {agent: buffers[agent].host_rewards for agent in models}
+    host_dones = {agent: buffers[agent].host_dones for agent in models}
+
+    # The buffers are reused across calls; every slot is overwritten below except the initial recurrent state and done flags
+    for agent in models:
+        lstm_hidden_states[agent][0].zero_()
+        lstm_cell_states[agent][0].zero_()
+        next_dones[agent].zero_()
+
+    def observation_slot(agent: str, step: int) -> torch.Tensor:
+        # Env observations are written straight into the rollout slot they are the input for; only the observation after
+        # the last step (used to bootstrap values) goes to next_observations
+        return all_observations[agent][step] if step < num_steps else next_observations[agent]
+
+    reset_observations, reset_goal_info = envs.reset(seeds, options={"block_penalty_coef": block_penalty_coef})
+    for agent in observation_owners:
+        observation_slot(agent, 0).copy_(reset_observations[agent], non_blocking=True)
+    for agent in models:
+        host_goal_info[agent].numpy()[:] = reset_goal_info[agent]
+        next_goal_info[agent].copy_(host_goal_info[agent], non_blocking=True)
+
+    # One pinned array that the vector env reads actions from, overwritten every step. Stored (num_agents, num_envs) so each
+    # agent's row is contiguous and can be the target of an async copy; the env sees the (num_envs, num_agents) transpose.
+    agent_rows = {agent: envs.possible_agents.index(agent) for agent in models}
+    host_actions = torch.zeros((len(envs.possible_agents), num_envs), dtype=torch.long, pin_memory=torch.cuda.is_available())
+    # Recorded after each agent's action copy, so the env can step while the rest of the step's GPU work is still queued
+    actions_copied = {agent: torch.cuda.Event() for agent in models if torch.device(models[agent].device).type == 'cuda'}
+
+    # Gumbel noise for every sampling call of the rollout, drawn in one kernel up front (when all agents share a device)
+    model_devices = {torch.device(model.device) for model in models.values()}
+    rollout_noise = gumbel_noise((num_steps, len(models) * num_envs, envs.action_space.n), model_devices.pop()) if len(model_devices) == 1 else None  # type: ignore
+
+    # The two agents' forwards are small and independent; on their own streams they can share the GPU instead of queueing
+    rollout_streams = {agent: torch.cuda.Stream(device=models[agent].device) for agent in models} if concurrent_agents else {}
 
     for step in range(num_steps):
-        step_actions = {}
+        observations = {agent: all_observations[agent][step] for agent in models}
 
+        trunk_features = None
+        if shared_trunk:
+            # Every agent sees the same board, so the shared conv trunk runs once per step for all of them
+            leader = models['leader']
+            with torch.no_grad(), autocast(leader.device, amp_dtype):
+                trunk_features = leader.trunk(observations['leader'])
+
+        outputs = {}
         for agent, model in models.items():
-            all_observations[agent][step] = next_observations[agent]
             all_goal_info[agent][step] = next_goal_info[agent]
             all_dones[agent][step] = next_dones[agent]
 
-            with torch.no_grad():
-                action, logprob, entropy, value, goalinfo_logits, (hidden_states, cell_states) = model.get_action_and_value(
-                    next_observations[agent],
-                    next_goal_info[agent],
-                    prev_hidden_and_cell_states=(lstm_hidden_states[agent][step], lstm_cell_states[agent][step]),
-                    sampling_temperature=sampling_temperature
-                )
-                step_actions[agent] = action.cpu().numpy()
+            stream = rollout_streams.get(agent)
+            if stream is not None:
+                stream.wait_stream(torch.cuda.current_stream(model.device))
+            with torch.cuda.stream(stream), torch.no_grad(), autocast(model.device, amp_dtype, cache_enabled=rollout_graphs is None):
+                if rollout_graphs is not None:
+                    outputs[agent] = rollout_graphs[agent](observations[agent], next_goal_info[agent], lstm_hidden_states[agent][step], lstm_cell_states[agent][step])
+                else:
+                    outputs[agent] = model(
+                        observations[agent],
+                        next_goal_info[agent],
+                        prev_hidden_and_cell_states=(lstm_hidden_states[agent][step], lstm_cell_states[agent][step]),
+                        trunk_features=trunk_features,
+                    )
+        for agent, stream in rollout_streams.items():
+            torch.cuda.current_stream(models[agent].device).wait_stream(stream)
+
+        with torch.no_grad():
+            actions = sample_agent_actions(
+                {agent: agent_outputs[0].float() for agent, agent_outputs in outputs.items()},
+                sampling_temperature,
+                noise=rollout_noise[step] if rollout_noise is not None else None,
+            )
+            for agent in models:
+                action, logprob, entropy, value, goalinfo_logits, (hidden_states, cell_states) = action_and_value_from_outputs(*outputs[agent], action=actions[agent])
+                host_actions[agent_rows[agent]].copy_(action, non_blocking=True)
+                if agent in actions_copied:
+                    actions_copied[agent].record(torch.cuda.current_stream(models[agent].device))
                 lstm_hidden_states[agent][step + 1] = hidden_states  # step + 1 so that indexing by step gives the *input* states at that step
                 lstm_cell_states[agent][step + 1] = cell_states  # step + 1 so that indexing by step gives the *input* states at that step
 
                 all_actions[agent][step] = action
                 all_logprobs[agent][step] = logprob
                 all_values[agent][step] = value.flatten()
-                all_entropies[agent][step] = entropy.flatten().cpu().numpy()
-
-        # Convert step_actions from dict of lists to list of dicts
-        step_actions = [{agent: step_actions[agent][i] for agent in step_actions} for i in range(len(step_actions[list(models.keys())[0]]))]
-
-        # Step the environment, and return results.
-        next_observation_dicts, reward_dicts, terminated_dicts, truncation_dicts, info_dicts, blocks_collected_dicts = list(zip(*[env.step(step_actions[i]) for i, env in enumerate(envs)]))
-        
-        next_observations = {agent: torch.stack([obs_dict[agent]['observation'] for obs_dict in next_observation_dicts]) for agent in models}
-        next_goal_info = {agent: np.array([obs_dict[agent]['goal_info'] for obs_dict in next_observation_dicts]) for agent in models}
-        rewards = {agent: np.array([reward_dict[agent] for reward_dict in reward_dicts]) for agent in models}
-        next_individual_rewards = {agent: np.array([info_dict[agent]["individual_reward"] for info_dict in info_dicts]) for agent in models}
-        next_shared_rewards = {agent: np.array([info_dict[agent]["shared_reward"] for info_dict in info_dicts]) for agent in models}
+                all_entropies[agent][step] = entropy.flatten()
+
+        # Only the action copies are waited on; the buffer writes above run on the GPU while the envs step on the CPU
+        for event in actions_copied.values():
+            event.synchronize()
+
+        # Step all environments at once; results come back batched as (num_envs, ...) arrays per agent
+        step_result = envs.step(host_actions.numpy().T)
+
+        for agent in observation_owners:
+            observation_slot(agent, step + 1).copy_(step_result.observations[agent], non_blocking=True)
         for agent in models:
-            all_rewards[agent][step] = torch.tensor(rewards[agent]).to(models[agent].device).view(-1)
-            all_individual_rewards[agent][step] = next_individual_rewards[agent].reshape(-1)
-            all_shared_rewards[agent][step] = next_shared_rewards[agent].reshape(-1)
+            host_goal_info[agent].numpy()[:] = step_result.goal_info[agent]
+            host_rewards[agent].numpy()[:] = step_result.rewards[agent]
+            next_goal_info[agent].copy_(host_goal_info[agent], non_blocking=True)
+            all_rewards[agent][step].copy_(host_rewards[agent], non_blocking=True)
+            all_individual_rewards[agent][step] = step_result.individual_rewards[agent]
+            all_shared_rewards[agent][step] = step_result.shared_rewards[agent]
             
             # blocks_collected_dict is 1 at a time. Append the latest value to appropriate tracker.
-            all_collect_blocks_goal[agent][step] = torch.tensor([bloc_dict[agent]["goal"] for bloc_dict in blocks_collected_dicts]).to(models[agent].device)
-            all_collect_blocks_incorrect[agent][step] = torch.tensor([bloc_dict[agent]["incorrect"] for bloc_dict in blocks_collected_dicts]).to(models[agent].device)
+            all_collect_blocks_goal[agent][step] = step_result.collected_blocks_goal[agent]
+            all_collect_blocks_incorrect[agent][step] = step_result.collected_blocks_incorrect[agent]
+
+        num_goals_switched = int(step_result.goal_switched.sum())
 
-        next_dones = {agent: np.logical_or([int(terminated[agent]) for terminated in terminated_dicts], [int(truncated[agent]) for truncated in truncation_dicts]) for agent in models}
-        num_goals_switched = sum(env.goal_switched for env in envs) # type: ignore
+        for agent in models:
+            host_dones[agent].numpy()[:] = step_result.dones[agent]
+            next_dones[agent].copy_(host_dones[agent], non_blocking=True)
 
-        # Convert to tensors
-        next_goal_info = {agent: torch.tensor(next_goal_info[agent], dtype=torch.float32).to(models[agent].device) for agent in models}
-        next_dones = {agent: torch.tensor(next_dones[agent], dtype=torch.float32).to(models[agent].device) for agent in models}
+        # Start finished episodes from a zero recurrent state
+        for agent in models:
+            lstm_hidden_states[agent][step + 1] *= 1 - next_dones[agent].unsqueeze(-1)
+            lstm_cell_states[agent][step + 1] *= 1 - next_dones[agent].unsqueeze(-1)
 
     explained_var = {}
     acc_losses = {agent: 0 for agent in models}
-    for agent, model in models.items():
-        # bootstrap values if not done
-        with torch.no_grad():
-            next_values = model.get_value(next_observations[agent], next_goal_info[agent], prev_hidden_and_cell_states=(lstm_hidden_states[agent][-1], lstm_cell_states[agent][-1])).reshape(1, -1)
-            advantages = torch.zeros_like(all_rewards[agent]).to(model.device)
-            lastgaelam = 0
-            for t in reversed(range(num_steps)):
-                if t == num_steps - 1:
-                    nextnonterminal = 1 - next_dones[agent]
-                    nextvalues = next_values
-                else:
-                    nextnonterminal = 1 - all_dones[agent][t + 1]
-                    nextvalues = all_values[agent][t + 1]
-                delta = all_rewards[agent][t] + gamma * nextvalues * nextnonterminal - all_values[agent][t]
-                advantages[t] = lastgaelam = delta + gamma * gae_lambda * nextnonterminal * lastgaelam
-            returns = advantages + all_values[agent]
-
-        # flatten the batch
-        b_obs = all_observations[agent].reshape((-1,) + observation_space_shapes[agent])  # (-1, 5, xBoundary, yBoundary)
-        b_logprobs = all_logprobs[agent].reshape(-1)
-        b_goal_info = all_goal_info[agent].reshape((-1,) + goal_info_shapes[agent])
-        b_actions = all_actions[agent].reshape((-1,) + action_space_shapes[agent])
-        b_advantages = advantages.reshape(-1)
-        b_returns = returns.reshape(-1)
-        b_values = all_values[agent].reshape(-1)
-        b_lstm_hidden_states = lstm_hidden_states[agent].reshape((-1, model.hidden_size))
-        b_lstm_cell_states = lstm_cell_states[agent].reshape((-1, model.hidden_size))
-
-        if training_agents[agent]:
-            # Optimizing the policy and value network
-            b_inds = np.arange(batch_size)
-            clipfracs = []
-            for epoch in range(ppo_update_epochs):
-                np.random.shuffle(b_inds)
-                for start in range(0, batch_size, minibatch_size):
-                    end = start + minibatch_size
-                    mb_inds = b_inds[start:end]
-
-                    _, newlogprob, entropy, newvalue, goalinfo_logits, _ = model.get_action_and_value(
-                        b_obs[mb_inds], 
-                        goal_info=b_goal_info.long()[mb_inds], 
-                        action=b_actions.long()[mb_inds],
-                        prev_hidden_and_cell_states=(b_lstm_hidden_states[mb_inds], b_lstm_cell_states[mb_inds]),
-                    )
-                    logratio = newlogprob - b_logprobs[mb_inds]
-                    ratio = logratio.exp()
-
-                    with torch.no_grad():
-                        # calculate approx_kl http://joschu.net/blog/kl-approx.html
-                        approx_kl = ((ratio - 1) - logratio).mean()
-                        clipfracs += [((ratio - 1.0).abs() > clip_param).float().mean().item()]
-
-                    mb_advantages = b_advantages[mb_inds]
-                    if norm_advantage:
-                        mb_advantages = (mb_advantages - mb_advantages.mean()) / (mb_advantages.std() + 1e-8)
-
-                    # Policy loss
-                    pg_loss1 = -mb_advantages * ratio
-                    pg_loss2 = -mb_advantages * torch.clamp(ratio, 1 - clip_param, 1 + clip_param)
-                    pg_loss = torch.max(pg_loss1, pg_loss2).mean()
-
-                    # Value loss
-                    newvalue = newvalue.view(-1)
-                    if clip_vloss:
-                        v_loss_unclipped = (newvalue - b_returns[mb_inds]) ** 2
-                        v_clipped = b_values[mb_inds] + torch.clamp(
-                            newvalue - b_values[mb_inds],
-                            -clip_param,
-                            clip_param,
-                        )
-                        v_loss_clipped = (v_clipped - b_returns[mb_inds]) ** 2
-                        v_loss_max = torch.max(v_loss_unclipped, v_loss_clipped)
-                        v_loss = 0.5 * v_loss_max.mean()
-                    else:
-                        v_loss = 0.5 * ((newvalue - b_returns[mb_inds]) ** 2).mean()
-
-                    # Auxiliary goalinfo prediction loss
-                    ce_loss_func = torch.nn.CrossEntropyLoss()
-                    goalinfo_loss = ce_loss_func(goalinfo_logits, b_goal_info.long()[mb_inds].argmax(dim=-1).view(-1))
-
-                    entropy_loss = entropy.mean()
-                    loss = pg_loss - entropy_coef * entropy_loss + v_loss * value_func_coef + goalinfo_loss * goalinfo_loss_coef
-                    acc_losses[agent] += loss.detach().cpu().item()
-
-                    optimizers[agent].zero_grad()
-                    loss.backward()
-                    nn.utils.clip_grad_norm_(model.parameters(), max_grad_norm)
-                    optimizers[agent].step()
-
-                if target_kl is not None and approx_kl > target_kl:
-                    break
+    acc_loss_tensors, return_stats = {}, {}
+    # The agents' updates are independent; on their own streams their small kernels can share the GPU
+    update_streams = {agent: torch.cuda.Stream(device=models[agent].device) for agent in models} if concurrent_updates else {}
+    loss_fn = compiled_ppo_losses() if compile_losses else ppo_losses
+
+    def minibatch_loss(model: ActorCritic, batch: dict, mb_inds, use_sequences: bool):
+        """PPO loss (plus the auxiliary goalinfo loss) of one agent on one minibatch of its flattened rollout."""
+        with autocast(model.device, amp_dtype):
+            if use_sequences:
+                initial_inds = mb_inds[:mb_inds.numel() // num_steps]  # The minibatch's envs at step 0
+                outputs = model.forward_sequence(
+                    batch['obs'][mb_inds].unflatten(0, (num_steps, -1)),
+                    batch['goal_info'][mb_inds].unflatten(0, (num_steps, -1)),
+                    initial_hidden_and_cell_states=(batch['lstm_hidden_states'][initial_inds], batch['lstm_cell_states'][initial_inds]),
+                    dones=batch['dones'][mb_inds].unflatten(0, (num_steps, -1)) if batch['dones'] is not None else None,
+                )
+                _, newlogprob, entropy, newvalue, goalinfo_logits, _ = action_and_value_from_outputs(*outputs, action=batch['actions'][mb_inds])
+            else:
+                _, newlogprob, entropy, newvalue, goalinfo_logits, _ = model.get_action_and_value(
+                    batch['obs'][mb_inds], 
+                    goal_info=batch['goal_info'][mb_inds], 
+                    action=batch['actions'][mb_inds],
+                    prev_hidden_and_cell_states=(batch['lstm_hidden_states'][mb_inds], batch['lstm_cell_states'][mb_inds]),
+                )
+        loss, approx_kl = loss_fn(
+            newlogprob, entropy, newvalue, batch['logprobs'][mb_inds], batch['advantages'][mb_inds], batch['returns'][mb_inds], batch['values'][mb_inds],
+            clip_param, entropy_coef, value_func_coef, clip_vloss, norm_advantage,
+        )
 
-        y_pred, y_true = b_values.cpu().numpy(), b_returns.cpu().numpy()
-        var_y = np.var(y_true)
-        explained_var[agent] = np.nan if var_y == 0 else 1 - np.var(y_true - y_pred) / var_y
+        # Auxiliary goalinfo prediction loss
+        if goalinfo_loss_coef != 0:
+            goalinfo_loss = F.cross_entropy(goalinfo_logits, batch['goal_targets'][mb_inds])
+            loss = loss + goalinfo_loss * goalinfo_loss_coef
+        return loss, approx_kl
+
+    # Agents sharing a trunk are updated as one group: their losses are summed into a single backward and optimizer step,
+    # so the trunk moves once per minibatch and both agents' ratios are measured against the same trunk
+    update_groups = [list(models)] if shared_trunk else [[agent] for agent in models]
+    for group in update_groups:
+        device = models[group[0]].device
+        stream = update_streams.get(group[0])
+        if stream is not None:
+            stream.wait_stream(torch.cuda.current_stream(device))
+        with torch.cuda.stream(stream):
+            batches = {}
+            for agent in group:
+                model = models[agent]
+                # bootstrap values if not done
+                with torch.no_grad(), autocast(model.device, amp_dtype):
+                    next_values = model.get_value(next_observations[agent], next_goal_info[agent], prev_hidden_and_cell_states=(lstm_hidden_states[agent][-1], lstm_cell_states[agent][-1])).reshape(1, -1)
+                    advantages = compute_gae(all_rewards[agent], all_values[agent], all_dones[agent], next_values, next_dones[agent], gamma, gae_lambda)
+                    returns = advantages + all_values[agent]
+
+                # flatten the batch
+                # The buffers were shaped from the spaces once in train(), so merging the (step, env) dims is all that is needed
+                b_goal_info = all_goal_info[agent].flatten(0, 1)
+                batches[agent] = dict(
+                    obs=all_observations[agent].flatten(0, 1),  # (-1, 5, xBoundary, yBoundary)
+                    logprobs=all_logprobs[agent].reshape(-1),
+                    goal_info=b_goal_info,
+                    goal_targets=b_goal_info.argmax(dim=-1),  # Auxiliary loss targets, computed once per rollout rather than per minibatch
+                    actions=all_actions[agent].flatten(0, 1),
+                    advantages=advantages.reshape(-1),
+                    returns=returns.reshape(-1),
+                    values=all_values[agent].reshape(-1),
+                    lstm_hidden_states=lstm_hidden_states[agent].reshape((-1, model.hidden_size)),
+                    lstm_cell_states=lstm_cell_states[agent].reshape((-1, model.hidden_size)),
+                    # One host sync per rollout: without episode restarts, each minibatch's LSTM pass is a single cuDNN call
+                    dones=all_dones[agent].reshape(-1) if sequence_bptt and model.use_lstm and bool(all_dones[agent].any()) else None,
+                )
 
-    step_result = {
-        agent: StepData(
-            observations=all_observations[agent].cpu(),
+                # Means and variances of the returns and of the value residuals, computed on device and read back together
+                b_returns, b_values = batches[agent]['returns'], batches[agent]['values']
+                b_residuals = b_returns - b_values
+                return_stats[agent] = torch.stack((b_returns.mean(), b_returns.var(correction=0), b_residuals.mean(), b_residuals.var(correction=0)))
+
+            training_group = [agent for agent in group if training_agents[agent]]
+            if training_group:
+                # Optimizing the policy and value network
+                # The group's agents share one optimizer and grad scaler; the ModuleList's parameters() counts a shared trunk once
+                group_module = nn.ModuleList([models[agent] for agent in training_group])
+                optimizer = optimizers[training_group[0]]
+                grad_scaler = grad_scalers[training_group[0]] if grad_scalers is not None else None
+                group_sequence_bptt = sequence_bptt and models[training_group[0]].use_lstm
+                if group_sequence_bptt:
+                    # Minibatches are whole env trajectories, indexed step-major so each one unflattens to (num_steps, envs_per_minibatch)
+                    envs_per_minibatch = max(1, minibatch_size // num_steps)
+                    step_offsets = (torch.arange(num_steps, device=device) * num_envs).unsqueeze(1)
+                # The loss accumulates on the device so the loop never waits on a .item() host sync
+                acc_loss = {agent: torch.zeros((), device=device) for agent in training_group}
+                for _ in range(ppo_update_epochs):
+                    # Permutations generated on the device, so indexing the batch with them never copies indices over PCIe
+                    if group_sequence_bptt:
+                        env_inds = torch.randperm(num_envs, device=device)
+                        minibatches = [(step_offsets + mb_envs).flatten() for mb_envs in env_inds.split(envs_per_minibatch)]
+                    else:
+                        minibatches = torch.randperm(batch_size, device=device).split(minibatch_size)
+                    for mb_inds in minibatches:
+                        loss, approx_kls = 0, []
+                        for agent in training_group:
+                            agent_loss, agent_approx_kl = minibatch_loss(models[agent], batches[agent], mb_inds, group_sequence_bptt)
+                            acc_loss[agent] += agent_loss.detach()
+                            loss = loss + agent_loss
+                            approx_kls.append(agent_approx_kl)
+
+                        optimizer.zero_grad()
+                        if grad_scaler is not None:
+                            # Loss scaling for fp16; the scaler is disabled (pass-through) otherwise
+                            grad_scaler.scale(loss).backward()
+                        else:
+                            loss.backward()
+                        if dist.is_initialized():
+                            all_reduce_gradients(group_module)
+                        if grad_scaler is not None:
+                            grad_scaler.unscale_(optimizer)
+                        nn.utils.clip_grad_norm_(group_module.parameters(), max_grad_norm)
+                        if grad_scaler is not None:
+                            grad_scaler.step(optimizer)
+                            grad_scaler.update()
+                        else:
+                            optimizer.step()
+
+                    if target_kl is not None:
+                        # A group stops as soon as any of its agents' policies has moved too far
+                        approx_kl = torch.stack(approx_kls).amax()
+                        if dist.is_initialized():
+                            # Every rank must take the same early-stopping decision, or the gradient all-reduces stop lining up
+                            dist.all_reduce(approx_kl)
+                            approx_kl /= dist.get_world_size()
+                        if approx_kl > target_kl:
+                            break
+
+                acc_loss_tensors.update(acc_loss)
+
+    for agent, stream in update_streams.items():
+        torch.cuda.current_stream(models[agent].device).wait_stream(stream)
+
+    # Host syncs wait until every agent's update is queued, so they do not serialize concurrent updates
+    for agent in models:
+        if agent in acc_loss_tensors:
+            acc_losses[agent] = acc_loss_tensors[agent].item()
+        means, variances = return_stats[agent][0::2], return_stats[agent][1::2]
+        if dist.is_initialized():
+            # Pool the (equally sized) rank batches before taking the ratio, so one rank with constant returns
+            # cannot turn the reported explained variance into NaN everywhere
+            moments = torch.cat((means, variances + means ** 2))
+            dist.all_reduce(moments)
+            moments /= dist.get_world_size()
+            variances = moments[2:] - moments[:2] ** 2
+        var_y, var_residual = variances.tolist()
+        explained_var[agent] = np.nan if var_y == 0 else 1 - var_residual / var_y
+
+    if dist.is_initialized():
+        # Report the loss averaged over ranks
+        for agent, model in models.items():
+            reported = torch.tensor(acc_losses[agent], device=model.device)
+            dist.all_reduce(reported)
+            reported /= dist.get_world_size()
+            acc_losses[agent] = reported.item()
+
+    # Copying the full rollout to the CPU is only worth it when the caller saves trajectories
+    trajectories = {
+        agent: dict(
+            observations=all_observations[agent].to('cpu', torch.float32),  # numpy has no bfloat16
             goal_info=all_goal_info[agent].cpu(),
             actions=all_actions[agent].cpu(),
             rewards=all_rewards[agent].cpu(),
-            individual_rewards=all_individual_rewards[agent],
-            shared_rewards=all_shared_rewards[agent],
             dones=all_dones[agent].cpu(),
             action_log_probs=all_logprobs[agent].cpu(),
-            action_entropies=all_entropies[agent],
             values=all_values[agent].cpu(),
+        ) if return_trajectories else {}
+        for agent in models
+    }
+    step_result = {
+        agent: StepData(
+            reward=all_rewards[agent].sum(dim=0).mean().item(),
+            individual_rewards=all_individual_rewards[agent],
+            shared_rewards=all_shared_rewards[agent],
+            action_entropy=all_entropies[agent].mean().item(),
             loss=acc_losses[agent] / ppo_update_epochs,
             explained_var=explained_var[agent],
-            collected_blocks_goal=all_collect_blocks_goal[agent], # Dict[str, Tensor] {"leader": Tensor(num_steps, len(envs)), "follower": Tensor(num_steps, len(envs))} 
-            collected_blocks_incorrect=all_collect_blocks_incorrect[agent], # Dict[str, Tensor] {"leader": Tensor(num_steps, len(envs)), "follower": Tensor(num_steps, len(envs))} 
+            collected_blocks_goal=buffers[agent].collected_blocks_goal, # Dict[str, Tensor] {"leader": Tensor(num_steps, len(envs)), "follower": Tensor(num_steps, len(envs))} 
+            collected_blocks_incorrect=buffers[agent].collected_blocks_incorrect, # Dict[str, Tensor] {"leader": Tensor(num_steps, len(envs)), "follower": Tensor(num_steps, len(envs))} 
+            **trajectories[agent],
         )
         for agent in models
     }
@@ -397,7 +824,16 @@ def train(
         warmstart_leader_path: str | None = None,  # If provided, loads an existing leader checkpoint at the start
         warmstart_follower_path: str | None = None,  # If provided, loads an existing follower checkpoint at the start
         use_lstm: bool = False,  # Whether to use an LSTM in the network architecture
+        lstm_bptt: bool = False,  # If True (with use_lstm), updates run the LSTM over whole rollout trajectories instead of single steps from stored states
+        share_trunk: bool = False,  # If True, leader and follower share one conv trunk (computed once per rollout step) and keep their own heads
         compile: bool = False,  # If True, uses torch.compile. May not be supported in all environments.
+        jit_script: bool = False,  # If True, compiles the model's feed-forward submodules with torch.jit.script
+        amp_dtype: str | None = None,  # 'bfloat16' or 'float16' to run model forwards under torch.autocast; fp32 if None
+        tf32: bool = False,  # If True, fp32 matmuls and convolutions (everything outside autocast) may use TF32 tensor cores on Ampere+ GPUs
+        cuda_graphs: bool = False,  # If True, captures the fixed-shape rollout forward in a CUDA graph and replays it every step
+        channels_last: bool = False,  # If True, stores conv weights and observations in NHWC (channels_last) layout
+        concurrent_agents: bool = False,  # If True, issues each agent's rollout forward on its own CUDA stream so they can overlap
+        concurrent_updates: bool = False,  # If True, issues each agent's PPO update on its own CUDA stream so they can overlap
         # Frozen expert leader params
         frozen_leader: bool = False,
         # Block reward parameters
@@ -418,6 +854,7 @@ def train(
         total_timesteps: int = 500000,  # Total number of environment timesteps to run the PPO training loop for
         learning_rate: float = 1e-4,  # default set from "Emergent Social Learning via Multi-agent Reinforcement Learning"
         num_envs: int = 4,  # Number of environments to collect rollouts in parallel
+        async_envs: bool = False,  # If True, steps each environment in its own worker process (envs run on the CPU)
         num_steps_per_rollout: int = 128,  # Number of steps in each rollout
         gamma: float = 0.99,  # discount factor
         gae_lambda: float = 0.95,  # lambda for general advantage estimation
@@ -444,26 +881,55 @@ def train(
     if resume_iter:
         assert resume_wandb_id is not None, "Must provide W&B ID to resume from checkpoint"
 
+    # Launched with torchrun: every rank collects rollouts from its own num_envs envs, and gradients are averaged across ranks
+    if 'LOCAL_RANK' in os.environ:
+        dist.init_process_group(backend='nccl' if torch.cuda.is_available() else 'gloo')
+        if torch.cuda.is_available():
+            torch.cuda.set_device(int(os.environ['LOCAL_RANK']))
+        rank, world_size = dist.get_rank(), dist.get_world_size()
+    else:
+        rank, world_size = 0, 1
+    is_main_process = rank == 0
+    log_to_wandb = log_to_wandb and is_main_process
+
     if log_to_wandb:
         wandb.init(entity='wandb_id', project='project', name=run_name, resume=('must' if resume_wandb_id else False), id=resume_wandb_id)
     os.makedirs(f'results/{run_name}', exist_ok=True)
 
-    torch.manual_seed(seed)
-    env_seeds = [seed + i for i in range(num_envs)]
+    torch.manual_seed(seed + rank)
+    # Conv input shapes never change during training, so let cuDNN benchmark and cache the fastest algorithms
+    torch.backends.cudnn.benchmark = True
+    if tf32:
+        # Only ever switched on: cuDNN already defaults to TF32 convolutions, which --tf32 off must not disable
+        torch.backends.cuda.matmul.allow_tf32 = True
+        torch.backends.cudnn.allow_tf32 = True
+    env_seeds = [seed + rank * num_envs + i for i in range(num_envs)]
 
-    batch_size = num_envs * num_steps_per_rollout
+    batch_size = num_envs * num_steps_per_rollout  # Per rank
     minibatch_size = batch_size // num_minibatches
-    num_iterations = total_timesteps // batch_size
+    num_iterations = total_timesteps // (batch_size * world_size)
+
+    def make_envs(reward_shaping_fns: list) -> VectorColorMaze:
+        # Subprocess workers keep their envs on the CPU; observations are copied to the model device once per step
+        env_fn = partial(ColorMaze, leader_only=leader_only, block_density=block_density, asymmetric=asymmetric, reward_shaping_fns=reward_shaping_fns, block_swap_prob=block_swap_prob, device='cpu' if async_envs else DEVICE, positive_reward=positive_reward, negative_reward=negative_reward, is_unique_hemispheres_env=use_hemisphere)
+        return VectorColorMaze([env_fn] * num_envs, use_subprocess=async_envs)
 
     # Conditionally use reward shaping based on args
     if reward_shaping_func:
         reward_shaping_cls = ColorMazeRewards(close_threshold=reward_shaping_close_threshold, penalty=reward_shaping_penalty)
         reward_shaping = getattr(reward_shaping_cls, reward_shaping_func)
-        envs = [ColorMaze(leader_only=leader_only, block_density=block_density, asymmetric=asymmetric, reward_shaping_fns=[reward_shaping], block_swap_prob=block_swap_prob, device=DEVICE, positive_reward=positive_reward, negative_reward=negative_reward, is_unique_hemispheres_env=use_hemisphere) for _ in range(num_envs)]
+        envs = make_envs([reward_shaping])
     else:
-        envs = [ColorMaze(leader_only=leader_only, block_density=block_density, asymmetric=asymmetric, block_swap_prob=block_swap_prob, device=DEVICE, positive_reward=positive_reward, negative_reward=negative_reward, is_unique_hemispheres_env=use_hemisphere) for _ in range(num_envs)]
+        envs = make_envs([])
+    reward_shaping_active = bool(reward_shaping_func)
 
-    if torch.cuda.device_count() > 1:
+    if dist.is_initialized():
+        rank_device = f'cuda:{torch.cuda.current_device()}' if torch.cuda.is_available() else DEVICE
+        model_devices = {
+            'leader': rank_device,
+            'follower': rank_device
+        }
+    elif torch.cuda.device_count() > 1:
         model_devices = {
             'leader': 'cuda:0',
             'follower': 'cuda:1'
@@ -475,18 +941,30 @@ def train(
         }
 
     # Observation and action spaces are the same for leader and follower
-    act_space = envs[0].action_space
-    leader_obs_space = envs[0].observation_spaces['leader']
+    act_space = envs.action_space
+    leader_obs_space = envs.observation_spaces['leader']
     leader = ActorCritic(leader_obs_space['observation'], act_space, model_devices['leader'], use_lstm=use_lstm)  # type: ignore
     leader_optimizer = optim.Adam(leader.parameters(), lr=learning_rate, eps=1e-5)
     if leader_only:
         models = {'leader': leader}
         optimizers = {'leader': leader_optimizer}
     else:
-        follower_obs_space = envs[0].observation_spaces['follower']
+        follower_obs_space = envs.observation_spaces['follower']
         # follower uses LSTM if asymmetric is true
         follower = ActorCritic(follower_obs_space['observation'], act_space, model_devices['follower'], use_lstm=use_lstm) # type: ignore
-        follower_optimizer = optim.Adam(follower.parameters(), lr=learning_rate, eps=1e-5)
+        if share_trunk:
+            assert model_devices['leader'] == model_devices['follower'], "A shared trunk needs both models on one device"
+            assert not frozen_leader, "Training the follower would also change a frozen leader's shared trunk"
+            # Separate-model checkpoints fit neither the joint optimizer's two param groups nor one trunk for both agents
+            assert not (warmstart_leader_path or warmstart_follower_path), "Warmstarting is not supported with a shared trunk"
+            follower.share_trunk_with(leader)
+            # The trunk must be stepped by exactly one optimizer, so a single one holds the leader's parameters (trunk
+            # included) and, in its own param group, only the follower's heads; step() sums both agents' losses into it
+            leader_params = set(leader.parameters())
+            follower_optimizer = leader_optimizer
+            follower_optimizer.add_param_group({'params': [param for param in follower.parameters() if param not in leader_params]})
+        else:
+            follower_optimizer = optim.Adam(follower.parameters(), lr=learning_rate, eps=1e-5)
         models = {'leader': leader, 'follower': follower}
         optimizers = {'leader': leader_optimizer, 'follower': follower_optimizer}
 
@@ -531,9 +1009,28 @@ def train(
             optimizer_path = warmstart_follower_path.replace('iteration', 'optimizer_iteration')
             optimizers['follower'].load_state_dict(torch.load(optimizer_path))
 
+    if channels_last:
+        for model in models.values():
+            model.to(memory_format=torch.channels_last)
+
+    if dist.is_initialized():
+        # Start every rank from rank 0's weights
+        for model in models.values():
+            for param in model.parameters():
+                dist.broadcast(param.data, src=0)
+
+    if jit_script:
+        for model in models.values():
+            model.script_submodules(envs.observation_spaces['leader']['observation'].shape, num_envs)  # type: ignore
+        if share_trunk and not leader_only:
+            # Scripting replaced each model's submodules separately; point the follower back at the leader's
+            models['follower'].share_trunk_with(models['leader'])
+
     if compile:
-        for name, model in models.items():
-            models[name] = torch.compile(model, mode='reduce-overhead') # type: ignore
+        # Compiled in place rather than wrapped: a torch.compile wrapper only compiles direct calls, while get_value and
+        # get_action_and_value reached the eager module through attribute forwarding. Now every self(...) call is compiled.
+        for model in models.values():
+            model.compile(mode='reduce-overhead')
 
     assert no_block_penalty_until <= full_block_penalty_at
     if full_block_penalty_at == 0:
@@ -543,24 +1040,71 @@ def train(
         penalty_inc_per_step = 1 / (full_block_penalty_at - no_block_penalty_until)
         get_block_penalty_coef = lambda step: 0 if step <= no_block_penalty_until else min(1, penalty_inc_per_step * (step - no_block_penalty_until))
 
+    if amp_dtype is not None:
+        assert amp_dtype in ('bfloat16', 'float16'), f"Unsupported amp_dtype {amp_dtype}"
+    autocast_dtype = getattr(torch, amp_dtype) if amp_dtype is not None else None
+    # fp16 needs loss scaling to avoid gradient underflow; bf16 has fp32's exponent range and does not
+    grad_scalers = {
+        name: torch.amp.GradScaler(torch.device(model.device).type, enabled=autocast_dtype == torch.float16)
+        for name, model in models.items()
+    }
+    if share_trunk and not leader_only:
+        # The agents share one optimizer, which one scaler must step
+        grad_scalers['follower'] = grad_scalers['leader']
+
+    # Space shapes are looked up once here; step() only ever sees buffers already shaped from them
+    observation_shape = envs.observation_spaces['leader']['observation'].shape  # type: ignore
+    goal_info_shape = envs.observation_spaces['leader']['goal_info'].shape  # type: ignore
+    action_shape = envs.action_space.shape
+
+    if concurrent_agents:
+        assert torch.cuda.is_available(), "Concurrent agent forwards require a GPU"
+    if concurrent_updates:
+        assert torch.cuda.is_available(), "Concurrent agent updates require a GPU"
+        assert not share_trunk, "Concurrent updates would race on the shared trunk's parameters"
+
+    rollout_graphs = None
+    if cuda_graphs:
+        assert torch.cuda.is_available(), "CUDA graphs require a GPU"
+        assert not compile, "torch.compile(mode='reduce-overhead') already uses CUDA graphs"
+        assert not share_trunk, "Captured rollout graphs run the whole model, including the trunk"
+        rollout_graphs = {
+            name: CUDAGraphRollout(
+                model,
+                observation_zeros((num_envs,), observation_shape, channels_last, dtype=autocast_dtype or torch.float32, device=model.device),
+                torch.zeros((num_envs, NUM_COLORS), device=model.device),
+                torch.zeros((num_envs, model.hidden_size), device=model.device),
+                torch.zeros((num_envs, model.hidden_size), device=model.device),
+                amp_dtype=autocast_dtype,
+            )
+            for name, model in models.items()
+        }
+
+    # Rollout storage is allocated once and reused by every iteration
+    buffers = RolloutBuffer.allocate(models, num_steps_per_rollout, num_envs, observation_shape, goal_info_shape, action_shape,  # type: ignore
+                                     amp_dtype=autocast_dtype, channels_last=channels_last)
+
     training_agents = {
         'leader': not frozen_leader,
         'follower': True
     }
 
-    print(f'Running for {num_iterations} iterations using {num_envs} envs with {batch_size=} and {minibatch_size=}')
+    print(f'Running for {num_iterations} iterations using {num_envs} envs on each of {world_size} rank(s) with {batch_size=} and {minibatch_size=}')
     print(f'No block penalty until {no_block_penalty_until}, full {negative_reward} penalty after {full_block_penalty_at} timesteps. Increment by {penalty_inc_per_step} per timestep')
 
 
-    for iteration in tqdm(range(num_iterations), total=num_iterations):
+    for iteration in tqdm(range(num_iterations), total=num_iterations, disable=not is_main_process):
         if resume_iter and iteration <= resume_iter:
             continue
 
-        if reward_shaping_func and iteration * batch_size > reward_shaping_timesteps:
+        if reward_shaping_active and iteration * batch_size * world_size > reward_shaping_timesteps:
             # Disable reward shaping if timestep threshold is exceeded
-            envs = [ColorMaze(leader_only=leader_only, block_density=block_density, asymmetric=asymmetric, block_swap_prob=block_swap_prob, device=DEVICE, positive_reward=positive_reward, negative_reward=negative_reward, is_unique_hemispheres_env=use_hemisphere) for _ in range(num_envs)]
+            envs.close()
+            envs = make_envs([])
+            reward_shaping_active = False
 
-        block_penalty_coef = get_block_penalty_coef(iteration * batch_size)
+        block_penalty_coef = get_block_penalty_coef(iteration * batch_size * world_size)
+        save_trajectories = is_main_process and save_data_iters and iteration % save_data_iters == 0
         step_results, num_goals_switched = step(
             envs=envs,
             models=models,
@@ -582,7 +1126,17 @@ def train(
             block_penalty_coef=block_penalty_coef,
             sampling_temperature=sampling_temperature,
             goalinfo_loss_coef=goalinfo_loss_coef,
-            training_agents=training_agents
+            training_agents=training_agents,
+            amp_dtype=autocast_dtype,
+            grad_scalers=grad_scalers,
+            rollout_graphs=rollout_graphs,
+            buffers=buffers,
+            concurrent_agents=concurrent_agents,
+            sequence_bptt=lstm_bptt,
+            shared_trunk=share_trunk and not leader_only,
+            concurrent_updates=concurrent_updates,
+            compile_losses=compile,
+            return_trajectories=bool(save_trajectories),
         )
 
         metrics = {}
@@ -590,37 +1144,35 @@ def train(
             metrics[agent] = {
                 'loss': results.loss,
                 'explained_var': results.explained_var,
-                'reward': results.rewards.sum(dim=0).mean(),  # Sum along step dim and average along env dim
+                'reward': results.reward,
                 'individual_reward': results.individual_rewards.sum(axis=0).mean(),
                 'positive_individual_reward': (results.individual_rewards > 0).sum(axis=0).mean(),
                 'shared_reward': results.shared_rewards.sum(axis=0).mean(),
-                'action_entropy': results.action_entropies.mean(),
+                'action_entropy': results.action_entropy,
                 'collected_goal_blocks': results.collected_blocks_goal.sum(dim=0).mean(),
                 'collected_incorrect_blocks': results.collected_blocks_incorrect.sum(dim=0).mean(),
             }
-        metrics['timesteps'] = (iteration + 1) * batch_size
+        metrics['timesteps'] = (iteration + 1) * batch_size * world_size
         metrics['num_goals_switched'] = num_goals_switched
         metrics['block_penalty'] = block_penalty_coef
 
         if log_to_wandb:
             wandb.log(metrics, step=iteration)
 
-        if save_data_iters and iteration % save_data_iters == 0:
-            # Transpose observations so the dims are (env, step, ...observation_shape)
-            observation_states = step_results['leader'].observations.transpose(0, 1)  # type: ignore 
-            # Transpose goal_infos into shape: (env, step, goal_dim)
-            goal_infos = step_results['leader'].goal_info.transpose(0, 1) # type: ignore
-            for i in range(observation_states.size(0)):
-                trajectory = observation_states[i].numpy()
-                goal_infos_i = goal_infos[i].numpy()
-                os.makedirs(f'trajectories/{run_name}', exist_ok=True)
-                np.save(f"trajectories/{run_name}/trajectory_{iteration=}_env={i}.npy", trajectory)
-                np.save(f"trajectories/{run_name}/goal_info_{iteration=}_env={i}.npy", goal_infos_i)
+        if save_trajectories:
+            # The rollout was copied to the host once by step(); these are numpy views of that copy with dims (env, step, ...)
+            observation_states = step_results['leader'].observations.transpose(0, 1).numpy()  # type: ignore 
+            goal_infos = step_results['leader'].goal_info.transpose(0, 1).numpy() # type: ignore
+            os.makedirs(f'trajectories/{run_name}', exist_ok=True)
+            for i in range(len(observation_states)):
+                # Plain float arrays: allow_pickle=False skips the pickle fallback and guarantees the files load without it
+                np.save(f"trajectories/{run_name}/trajectory_{iteration=}_env={i}.npy", observation_states[i], allow_pickle=False)
+                np.save(f"trajectories/{run_name}/goal_info_{iteration=}_env={i}.npy", goal_infos[i], allow_pickle=False)
 
         if debug_print:
             print(f"iter {iteration}: {metrics}")
 
-        if checkpoint_iters and iteration % checkpoint_iters == 0:
+        if is_main_process and checkpoint_iters and iteration % checkpoint_iters == 0:
             print(f"Saving models at epoch {iteration}")
             for agent_name, model in models.items():
                 torch.save(model.state_dict(), f'results/{run_name}/{agent_name}_{iteration=}.pth')
@@ -631,8 +1183,14 @@ def train(
                     os.remove(f'results/{run_name}/{agent_name}_iteration={iteration - checkpoint_iters}.pth')
                     os.remove(f'results/{run_name}/{agent_name}_optimizer_iteration={iteration - checkpoint_iters}.pth')
 
-        for i in range(len(envs)):
-            env_seeds[i] += len(envs)
+        for i in range(num_envs):
+            env_seeds[i] += num_envs * world_size
+
+    envs.close()
+    if dist.is_initialized():
+        dist.destroy_process_group()
+    if not is_main_process:
+        return
 
     for agent_name, model in models.items():
         print(iteration)
@@ -0,0 +1,174 @@
+"""
+Vectorized wrapper that steps several ColorMaze environments in lock-step and returns batched results keyed by agent.
+Environments whose episode ends are reset in place, so the batch can be stepped indefinitely.
+
+With use_subprocess=True every environment lives in its own worker process, so the (pure Python) env steps run in parallel
+instead of one after another on the main thread. Workers should build their envs on the CPU.
+"""
+import multiprocessing as mp
+from dataclasses import dataclass
+from typing import Any, Callable, Sequence
+
+import numpy as np
+import torch
+
+from color_maze import ColorMaze
+
+
+@dataclass
+class VectorStepResult:
+    observations: dict[str, torch.Tensor]  # agent -> (num_envs, channels, x, y)
+    goal_info: dict[str, np.ndarray]  # agent -> (num_envs, NUM_COLORS)
+    rewards: dict[str, np.ndarray]  # agent -> (num_envs,)
+    dones: dict[str, np.ndarray]  # agent -> (num_envs,), terminated or truncated
+    individual_rewards: dict[str, np.ndarray]
+    shared_rewards: dict[str, np.ndarray]
+    collected_blocks_goal: dict[str, np.ndarray]  # 0 or 1
+    collected_blocks_incorrect: dict[str, np.ndarray]  # 0 or 1
+    goal_switched: np.ndarray  # (num_envs,)
+
+
+def _reset_env(env: ColorMaze, seed: int, options: dict | None, to_numpy: bool) -> tuple:
+    observations, _ = env.reset(seed=seed, options=options)
+    return _unpack_observations(observations, to_numpy)
+
+
+def _step_env(env: ColorMaze, actions: dict[str, int], to_numpy: bool) -> tuple:
+    observations, rewards, terminateds, truncateds, infos, blocks_collected = env.step(actions)
+    observation, goal_info = _unpack_observations(observations, to_numpy)
+    dones = {agent: terminateds[agent] or truncateds[agent] for agent in terminateds}
+    individual_rewards = {agent: infos[agent]["individual_reward"] for agent in infos}
+    shared_rewards = {agent: infos[agent]["shared_reward"] for agent in infos}
+    collected_goal = {agent: blocks_collected[agent]["goal"] for agent in blocks_collected}
+    collected_incorrect = {agent: blocks_collected[agent]["incorrect"] for agent in blocks_collected}
+    if any(dones.values()):
+        # Auto-reset: dones reports the finished episode while the observation is the first of the next one.
+        # The new seed comes from the env's own rng so runs stay reproducible; block_penalty_coef carries over.
+        observation, goal_info = _reset_env(env, int(env.rng.integers(2**31)), None, to_numpy)
+    return observation, goal_info, rewards, dones, individual_rewards, shared_rewards, collected_goal, collected_incorrect, env.goal_switched
+
+
+def _unpack_observations(observations: dict[str, dict[str, Any]], to_numpy: bool) -> tuple:
+    """Every agent observes the same board, so only one observation is kept per env."""
+    observation = next(iter(observations.values()))["observation"]
+    if to_numpy:
+        observation = observation.cpu().numpy()
+    goal_info = {agent: obs_dict["goal_info"] for agent, obs_dict in observations.items()}
+    return observation, goal_info
+
+
+def _fill_actions(env_actions: dict[str, Any], agents: Sequence[str], actions: np.ndarray):
+    """Writes one env's row of the (num_envs, num_agents) action array into its reusable {agent: action} dict."""
+    for agent, action in zip(agents, actions):
+        env_actions[agent] = action
+
+
+def _worker(remote, parent_remote, env_fn: Callable[[], ColorMaze]):
+    parent_remote.close()
+    env = env_fn()
+    env_actions = {}
+    while True:
+        cmd, data = remote.recv()
+        if cmd == "step":
+            _fill_actions(env_actions, env.possible_agents, data)
+            remote.send(_step_env(env, env_actions, to_numpy=True))
+        elif cmd == "reset":
+            remote.send(_reset_env(env, *data, to_numpy=True))
+        elif cmd == "spaces":
+            remote.send((env.possible_agents, env.observation_spaces, env.action_space))
+        elif cmd == "close":
+            remote.close()
+            break
+        else:
+            raise NotImplementedError(f"Unknown command {cmd}")
+
+
+class VectorColorMaze:
+    def __init__(self, env_fns: Sequence[Callable[[], ColorMaze]], use_subprocess: bool = False):
+        """env_fns: one picklable constructor per env, e.g. functools.partial(ColorMaze, device='cpu')."""
+        self.num_envs = len(env_fns)
+        self.use_subprocess = use_subprocess
+        if use_subprocess:
+            # spawn rather than fork, since the parent process may already hold a CUDA context
+            ctx = mp.get_context("spawn")
+            self.remotes, work_remotes = zip(*[ctx.Pipe() for _ in range(self.num_envs)])
+            self.processes = []
+            for work_remote, remote, env_fn in zip(work_remotes, self.remotes, env_fns):
+                process = ctx.Process(target=_worker, args=(work_remote, remote, env_fn), daemon=True)
+                process.start()
+                self.processes.append(process)
+                work_remote.close()
+            self.remotes[0].send(("spaces", None))
+            self.possible_agents, self.observation_spaces, self.action_space = self.remotes[0].recv()
+            # Worker observations land in one pinned host buffer, so the caller's copy to the GPU can be asynchronous
+            observation_shape = self.observation_spaces[self.possible_agents[0]]["observation"].shape
+            self._observations = torch.zeros((self.num_envs,) + observation_shape, pin_memory=torch.cuda.is_available())
+        else:
+            self.envs = [env_fn() for env_fn in env_fns]
+            self.possible_agents = self.envs[0].possible_agents
+            self.observation_spaces = self.envs[0].observation_spaces
+            self.action_space = self.envs[0].action_space
+            # Reused by every step, so stepping allocates no per-env action dicts
+            self._env_actions = [{agent: 0 for agent in self.possible_agents} for _ in range(self.num_envs)]
+            # Each env builds its observations directly in its row of the batch, so batching them is free
+            observation_shape = self.observation_spaces[self.possible_agents[0]]["observation"].shape
+            self._observations = torch.zeros((self.num_envs,) + observation_shape, device=self.envs[0].device)
+            for env, observation_row in zip(self.envs, self._observations):
+                env.bind_observation_buffer(observation_row)
+
+    def reset(self, seeds: Sequence[int], options: dict | None = None) -> tuple[dict[str, torch.Tensor], dict[str, np.ndarray]]:
+        """Returns the batched observation and goal info of every agent. The observation is valid until the next step or reset."""
+        if self.use_subprocess:
+            for remote, seed in zip(self.remotes, seeds):
+                remote.send(("reset", (seed, options)))
+            results = [remote.recv() for remote in self.remotes]
+        else:
+            results = [_reset_env(env, seed, options, to_numpy=False) for env, seed in zip(self.envs, seeds)]
+        observations, goal_infos = zip(*results)
+        observation = self._stack_observations(observations)
+        return (
+            {agent: observation for agent in self.possible_agents},
+            {agent: np.array([goal_info[agent] for goal_info in goal_infos]) for agent in self.possible_agents},
+        )
+
+    def step(self, actions: np.ndarray) -> VectorStepResult:
+        """actions: (num_envs, num_agents) integer array, with columns ordered as possible_agents."""
+        if self.use_subprocess:
+            for remote, env_actions in zip(self.remotes, actions):
+                remote.send(("step", env_actions))
+            results = [remote.recv() for remote in self.remotes]
+        else:
+            for env_actions, row in zip(self._env_actions, actions):
+                _fill_actions(env_actions, self.possible_agents, row)
+            results = [_step_env(env, env_actions, to_numpy=False) for env, env_actions in zip(self.envs, self._env_actions)]
+        observations, goal_infos, rewards, dones, individual_rewards, shared_rewards, collected_goal, collected_incorrect, goal_switched = zip(*results)
+
+        def batch(per_env_dicts):
+            return {agent: np.array([per_env[agent] for per_env in per_env_dicts]) for agent in self.possible_agents}
+
+        observation = self._stack_observations(observations)
+        return VectorStepResult(
+            observations={agent: observation for agent in self.possible_agents},
+            goal_info=batch(goal_infos),
+            rewards=batch(rewards),
+            dones=batch(dones),
+            individual_rewards=batch(individual_rewards),
+            shared_rewards=batch(shared_rewards),
+            collected_blocks_goal=batch(collected_goal),
+            collected_blocks_incorrect=batch(collected_incorrect),
+            goal_switched=np.array(goal_switched),
+        )
+
+    def _stack_observations(self, observations: Sequence[torch.Tensor | np.ndarray]) -> torch.Tensor:
+        """Returns the preallocated batch buffer, which the next step or reset overwrites."""
+        if self.use_subprocess:
+            np.stack(observations, out=self._observations.numpy())  # type: ignore
+        # In-process envs already wrote their observations into their rows of the buffer
+        return self._observations
+
+    def close(self):
+        if self.use_subprocess:
+            for remote in self.remotes:
+                remote.send(("close", None))
+            for process in self.processes:
+                process.join()